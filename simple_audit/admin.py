@@ -1,14 +1,26 @@
 # -*- coding:utf-8 -*_
 from __future__ import absolute_import
-from django.contrib import admin
+
+import collections
+import uuid
+
+from django.contrib import admin, messages
 from django.contrib.admin import SimpleListFilter
+from django.contrib.admin.views.main import ORDER_VAR, PAGE_VAR, ChangeList
+from django.contrib.auth import get_permission_codename
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.db.models import Q, prefetch_related_objects
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
 from django.urls import reverse, path
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
-from django.shortcuts import redirect
+from django.shortcuts import get_object_or_404, redirect
 
+from . import revert, search, settings
 from .models import Audit, AuditChange
 from .signal import MODEL_LIST
 
@@ -44,6 +56,84 @@ class ContentTypeListFilter(SimpleListFilter):
             return queryset
 
 
+CURSOR_VAR = "cursor"
+
+
+class CappedCountPaginator(Paginator):
+    """
+    Paginator which counts at most DJANGO_SIMPLE_AUDIT_ADMIN_COUNT_LIMIT rows, so the
+    count of a large audit table stops early instead of reading all of it.
+    """
+    capped = False
+
+    @cached_property
+    def count(self):
+        limit = settings.DJANGO_SIMPLE_AUDIT_ADMIN_COUNT_LIMIT
+        count = self.object_list[:limit + 1].count()
+        self.capped = count > limit
+        return min(count, limit)
+
+
+def parse_cursor(value):
+    """
+    Returns the (date, id) of a cursor, or None if it is not a valid one.
+    """
+    try:
+        date, audit_id = value.rsplit(",", 1)
+        date = parse_datetime(date)
+        return (date, int(audit_id)) if date else None
+    except (AttributeError, ValueError):
+        return None
+
+
+class AuditChangeList(ChangeList):
+    """
+    Changelist which pages by a (date, id) cursor instead of an offset: the link to the
+    older audits starts after the last one of the page, and is served by the date index
+    however deep it goes.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.cursor = parse_cursor(request.GET.get(CURSOR_VAR))
+        super(AuditChangeList, self).__init__(request, *args, **kwargs)
+        self.params.pop(CURSOR_VAR, None)
+
+    def get_filters_params(self, params=None):
+        params = super(AuditChangeList, self).get_filters_params(params)
+        params.pop(CURSOR_VAR, None)
+        return params
+
+    def get_queryset(self, request, *args, **kwargs):
+        qs = super(AuditChangeList, self).get_queryset(request, *args, **kwargs)
+        if self.cursor is not None:
+            date, audit_id = self.cursor
+            qs = qs.filter(Q(date__lt=date) | Q(date=date, id__lt=audit_id)).order_by("-date", "-id")
+        return qs
+
+    def get_results(self, request):
+        super(AuditChangeList, self).get_results(request)
+        # the objects of audits stored without a description are shown with their current
+        # description, read with one query per model for the whole page
+        self.result_list = list(self.result_list)
+        prefetch_related_objects(
+            [audit for audit in self.result_list if not audit.obj_description], "content_object"
+        )
+
+    def next_page_url(self):
+        """
+        The url of the audits older than the last one of the page, if there may be any.
+        """
+        results = list(self.result_list)
+        # the cursor only follows the default ordering
+        if len(results) < self.list_per_page or ORDER_VAR in self.params:
+            return None
+        last = results[-1]
+        return self.get_query_string({CURSOR_VAR: "%s,%d" % (last.date.isoformat(), last.id)}, [PAGE_VAR])
+
+    def first_page_url(self):
+        return self.get_query_string(remove=[PAGE_VAR])
+
+
 class AuditChangeInline(admin.TabularInline):
     model = AuditChange
     readonly_fields = ('field', 'old_value', 'new_value')
@@ -62,7 +152,7 @@ class AuditChangeInline(admin.TabularInline):
 class AuditAdmin(admin.ModelAdmin):
     search_fields = (
         "description",
-        "audit_request__request_id",
+        "request_id",
         "obj_description",
         "object_id",
     )
@@ -73,22 +163,40 @@ class AuditAdmin(admin.ModelAdmin):
         "audit_user",
         "audit_description",
     )
-    list_filter = ("operation", ContentTypeListFilter)
-    list_select_related = ('audit_request', 'audit_request__user', 'content_type')
+    list_filter = ("operation", ContentTypeListFilter, ("date", admin.DateFieldListFilter))
+    list_select_related = ('user', 'content_type')
     readonly_fields = (
-        'content_type', 'operation', 'description', 'get_audit_request_date', 'get_audit_request_username',
+        'content_type', 'operation', 'get_description', 'get_audit_request_date', 'get_audit_request_username',
         'get_audit_request_ip', 'get_audit_request_path'
     )
-    date_hierarchy = 'date'
+    ordering = ("-date", "-id")
+    paginator = CappedCountPaginator
+    show_full_result_count = False
     inlines = [AuditChangeInline]
+    actions = ["revert_audits", "revert_requests"]
 
     fieldsets = (
-        ('Object info', {'fields': ('operation', 'description')}),
+        ('Object info', {'fields': ('operation', 'get_description')}),
         ('Request info', {'fields': (
             'get_audit_request_date', 'get_audit_request_username', 'get_audit_request_ip', 'get_audit_request_path'
         )})
     )
 
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and search.get_backend() is not None:
+            # request ids and object ids are not in the index, they are looked up as search_fields did
+            term = search_term.strip()
+            exact = Q(request_id=term)
+            try:
+                exact |= Q(object_id=uuid.UUID(term))
+            except ValueError:
+                pass
+            return queryset.search(search_term) | queryset.filter(exact), False
+        return super(AuditAdmin, self).get_search_results(request, queryset, search_term)
+
+    def get_changelist(self, request, **kwargs):
+        return AuditChangeList
+
     def get_urls(self):
         urls = super(AuditAdmin, self).get_urls()
         my_urls = [
@@ -101,20 +209,68 @@ class AuditAdmin(admin.ModelAdmin):
         return my_urls + urls
 
     def revert_change(self, request, audit_id):
-        audit = Audit.objects.get(pk=audit_id)
-        if audit.operation == Audit.CHANGE:
-            audit_obj = audit.content_object
-            for change in audit.field_changes.all():
-                setattr(audit_obj, change.field, change.old_value)
-            audit_obj.save(force_insert=False)
-        elif audit.operation == Audit.DELETE:
-            audit_obj = audit.content_type.model_class()(pk=audit.object_id)
-            for change in audit.field_changes.all():
-                setattr(audit_obj, change.field, change.new_value)
-            audit_obj.save(force_insert=True)
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        audit = get_object_or_404(Audit, pk=audit_id)
+        if audit.operation != Audit.ADD:
+            self.run_revert(request, Audit.objects.filter(pk=audit.pk))
 
         return redirect("admin:simple_audit_audit_changelist")
 
+    @admin.action(description=_("Revert selected audits"), permissions=["change"])
+    def revert_audits(self, request, queryset):
+        self.run_revert(request, queryset)
+
+    @admin.action(description=_("Revert the requests of selected audits"), permissions=["change"])
+    def revert_requests(self, request, queryset):
+        self.run_revert(request, Audit.objects.filter(
+            audit_request__in=queryset.exclude(audit_request=None).values("audit_request")
+        ))
+
+    def has_revert_permission(self, request, audits):
+        """
+        Whether the user may write what reverting audits writes: change their objects, and
+        delete the added ones and add back the deleted ones, as the admin of their model (or
+        the model permissions, when it has no admin) allows it.
+        """
+        actions = collections.defaultdict(lambda: collections.defaultdict(set))
+        for content_type_id, object_id, operation in audits.values_list("content_type_id", "object_id", "operation"):
+            actions[content_type_id]["change"].add(object_id)
+            if operation == Audit.ADD:
+                actions[content_type_id]["delete"].add(object_id)
+            elif operation == Audit.DELETE:
+                actions[content_type_id]["add"].add(object_id)
+
+        for content_type_id, object_ids in actions.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is None:
+                return False
+            model_admin = self.admin_site._registry.get(model)
+            if model_admin is None:
+                if not all(request.user.has_perm("%s.%s" % (
+                        model._meta.app_label, get_permission_codename(action, model._meta))) for action in object_ids):
+                    return False
+                continue
+            if object_ids["add"] and not model_admin.has_add_permission(request):
+                return False
+            instances = model._default_manager.in_bulk(list(object_ids["change"]))
+            for action in ("change", "delete"):
+                has_permission = getattr(model_admin, "has_%s_permission" % action)
+                if not all(has_permission(request, instances.get(pk)) for pk in object_ids[action]):
+                    return False
+        return True
+
+    def run_revert(self, request, audits):
+        if not self.has_revert_permission(request, audits):
+            self.message_user(request, _("You do not have permission to revert these audits"), messages.ERROR)
+            return
+        try:
+            written = revert.revert(audits)
+        except revert.RevertError as e:
+            self.message_user(request, str(e), messages.ERROR)
+        else:
+            self.message_user(request, _("%d objects reverted") % written, messages.SUCCESS)
+
     def get_audit_request_date(self, obj):
         return obj.audit_request.date
     get_audit_request_date.short_description = "Date"
@@ -143,7 +299,7 @@ class AuditAdmin(admin.ModelAdmin):
         description=_("Description")
     )
     def audit_description(self, audit):
-        desc = "<br/>".join(escape(audit.description or "").split('\n'))
+        desc = "<br/>".join(escape(audit.get_description() or "").split('\n'))
         return mark_safe(desc)
 
 
@@ -167,25 +323,25 @@ class AuditAdmin(admin.ModelAdmin):
 
     @admin.display(
         description=_("User"),
-        ordering="audit_request__user",
+        ordering="user",
     )
     def audit_user(self, audit):
-        if audit.audit_request and audit.audit_request.user:
+        # ?user= filters on the user copied onto the audit, with the (user, date) index
+        if audit.user:
             link = u"<a title='%s' href='%s?user=%d'>%s</a>"
             return mark_safe(
                 link % (_("Click to filter"), reverse('admin:simple_audit_audit_changelist'),
-                        audit.audit_request.user.id, audit.audit_request.user)
+                        audit.user.id, audit.user)
             )
         else:
             return u"%s" % (_("unknown"))
 
 
-    def queryset(self, request):
-        request.GET = request.GET.copy()
-        user_filter = request.GET.pop("user", None)
-        qs = Audit.objects.prefetch_related("audit_request", "audit_request__user")
-        if user_filter:
-            qs = qs.filter(audit_request__user__in=user_filter)
+    def get_queryset(self, request):
+        qs = super(AuditAdmin, self).get_queryset(request)
+        if settings.DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES:
+            # descriptions of changes are rendered from their field changes
+            qs = qs.prefetch_related("field_changes")
         return qs
 
     def has_add_permission(self, request, obj=None):
@@ -0,0 +1,295 @@
+# -*- coding:utf-8 -*-
+"""
+Columnar archive of audits.
+
+Audits moved out of the database (see retention.py) can be packed into chunk
+files, one per batch, which store every column of the batch (the audits, their
+changes and their requests) as a separately zlib compressed JSON array. A chunk
+starts with a small header holding the offsets of its columns and its index:
+the id and date ranges of its audits, the audited models and a bloom filter of
+the audited objects.
+
+ArchiveReader answers lookups like history(obj) from the headers first, and
+only decompresses the columns of the chunks which may hold matching audits.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import base64
+import collections
+import hashlib
+import json
+import math
+import os
+import struct
+import zlib
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils.dateparse import parse_datetime
+
+MAGIC = b"SAC1"
+CHUNK_SUFFIX = ".sac"
+# false positive rate of the object bloom filters
+BLOOM_ERROR_RATE = 0.01
+
+AUDIT_COLUMNS = (
+    "id", "date", "operation", "content_type", "object_id", "description", "obj_description",
+    "user_id", "request_id", "request",
+)
+CHANGE_COLUMNS = ("audit", "field", "old_value", "new_value")
+REQUEST_COLUMNS = ("request_id", "ip", "path", "date", "user_id")
+
+ArchivedAudit = collections.namedtuple("ArchivedAudit", AUDIT_COLUMNS + ("changes",))
+
+
+class BloomFilter(object):
+
+    def __init__(self, size, hashes, bits=None):
+        self.size = size
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(size, hashes)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack(">QQ", digest)
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(key))
+
+    def to_dict(self):
+        return {"size": self.size, "hashes": self.hashes, "bits": base64.b64encode(bytes(self.bits)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["size"], data["hashes"], bytearray(base64.b64decode(data["bits"])))
+
+
+def content_type_label(content_type):
+    return "%s.%s" % content_type.natural_key()
+
+
+def object_key(label, object_id):
+    return "%s:%s" % (label, object_id)
+
+
+def columns(audits):
+    """
+    Returns the columns of saved audits, which have their content type, audit request
+    and field changes loaded, and the index of the chunk they fill.
+    """
+    content_types = []
+    requests = collections.OrderedDict()
+    data = dict(("audit.%s" % column, []) for column in AUDIT_COLUMNS)
+    data.update(("change.%s" % column, []) for column in CHANGE_COLUMNS)
+    data.update(("request.%s" % column, []) for column in REQUEST_COLUMNS)
+    bloom = BloomFilter.for_capacity(len(audits))
+
+    for row, audit in enumerate(audits):
+        label = content_type_label(audit.content_type)
+        if label not in content_types:
+            content_types.append(label)
+        request = None
+        if audit.audit_request_id is not None:
+            request = requests.setdefault(audit.audit_request_id, len(requests))
+        values = {
+            "id": audit.pk,
+            "date": audit.date.isoformat(),
+            "operation": audit.operation,
+            "content_type": content_types.index(label),
+            "object_id": str(audit.object_id),
+            "description": audit.description,
+            "obj_description": audit.obj_description,
+            "user_id": audit.user_id,
+            "request_id": audit.request_id,
+            "request": request,
+        }
+        for column in AUDIT_COLUMNS:
+            data["audit.%s" % column].append(values[column])
+        for change in audit.field_changes.all():
+            data["change.audit"].append(row)
+            data["change.field"].append(change.field)
+            data["change.old_value"].append(change.old_value)
+            data["change.new_value"].append(change.new_value)
+        bloom.add(object_key(label, audit.object_id))
+
+    audit_requests = dict((audit.audit_request_id, audit.audit_request) for audit in audits if audit.audit_request_id)
+    for request_pk in requests:
+        request = audit_requests[request_pk]
+        data["request.request_id"].append(request.request_id)
+        data["request.ip"].append(request.ip)
+        data["request.path"].append(request.path)
+        data["request.date"].append(request.date.isoformat())
+        data["request.user_id"].append(request.user_id)
+
+    dates = data["audit.date"]
+    index = {
+        "count": len(audits),
+        "first_id": min(data["audit.id"]),
+        "last_id": max(data["audit.id"]),
+        "first_date": min(dates),
+        "last_date": max(dates),
+        "content_types": content_types,
+        "bloom": bloom.to_dict(),
+    }
+    return data, index
+
+
+def write_chunk(directory, audits):
+    """
+    Packs saved audits into a chunk file named after their id range, replaced atomically,
+    and returns its path.
+    """
+    data, index = columns(audits)
+    blobs = []
+    offsets = {}
+    offset = 0
+    for name in sorted(data):
+        blob = zlib.compress(json.dumps(data[name]).encode("utf-8"), 9)
+        offsets[name] = (offset, len(blob))
+        offset += len(blob)
+        blobs.append(blob)
+    header = json.dumps({"index": index, "columns": offsets}).encode("utf-8")
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "chunk-%012d-%012d%s" % (index["first_id"], index["last_id"], CHUNK_SUFFIX))
+    with open(path + ".tmp", "wb") as chunk:
+        chunk.write(MAGIC + struct.pack(">I", len(header)) + header)
+        for blob in blobs:
+            chunk.write(blob)
+    os.rename(path + ".tmp", path)
+    return path
+
+
+class Chunk(object):
+    """
+    A chunk file, whose header is read when it is opened and whose columns are read
+    and decompressed on demand.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as chunk:
+            magic = chunk.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError("%s is not an audit archive chunk" % path)
+            length, = struct.unpack(">I", chunk.read(4))
+            header = json.loads(chunk.read(length).decode("utf-8"))
+        self.data_offset = len(MAGIC) + 4 + length
+        self.index = header["index"]
+        self.offsets = header["columns"]
+        self.bloom = BloomFilter.from_dict(self.index["bloom"])
+        self._columns = {}
+
+    def may_contain(self, label=None, object_id=None, since=None, until=None):
+        index = self.index
+        if label is not None and label not in index["content_types"]:
+            return False
+        if object_id is not None and object_key(label, object_id) not in self.bloom:
+            return False
+        if since is not None and parse_datetime(index["last_date"]) < since:
+            return False
+        if until is not None and parse_datetime(index["first_date"]) >= until:
+            return False
+        return True
+
+    def column(self, name):
+        if name not in self._columns:
+            offset, length = self.offsets[name]
+            with open(self.path, "rb") as chunk:
+                chunk.seek(self.data_offset + offset)
+                self._columns[name] = json.loads(zlib.decompress(chunk.read(length)).decode("utf-8"))
+        return self._columns[name]
+
+    def rows(self, label=None, object_id=None, since=None, until=None):
+        """
+        Returns the row numbers of the audits matching the filters, reading only the columns
+        they need.
+        """
+        rows = range(self.index["count"])
+        if label is not None:
+            content_type = self.index["content_types"].index(label)
+            content_types = self.column("audit.content_type")
+            rows = [row for row in rows if content_types[row] == content_type]
+        if object_id is not None:
+            object_ids = self.column("audit.object_id")
+            rows = [row for row in rows if object_ids[row] == str(object_id)]
+        if since is not None or until is not None:
+            dates = self.column("audit.date")
+            rows = [
+                row for row in rows
+                if (since is None or parse_datetime(dates[row]) >= since)
+                and (until is None or parse_datetime(dates[row]) < until)
+            ]
+        return list(rows)
+
+    def audits(self, rows):
+        if not rows:
+            return []
+        changes = collections.defaultdict(list)
+        wanted = set(rows)
+        for position, row in enumerate(self.column("change.audit")):
+            if row in wanted:
+                changes[row].append((
+                    self.column("change.field")[position],
+                    self.column("change.old_value")[position],
+                    self.column("change.new_value")[position],
+                ))
+        audits = []
+        for row in rows:
+            values = dict((column, self.column("audit.%s" % column)[row]) for column in AUDIT_COLUMNS)
+            values["date"] = parse_datetime(values["date"])
+            values["content_type"] = self.index["content_types"][values["content_type"]]
+            if values["request"] is not None:
+                values["request"] = dict(
+                    (column, self.column("request.%s" % column)[values["request"]]) for column in REQUEST_COLUMNS
+                )
+            audits.append(ArchivedAudit(changes=changes[row], **values))
+        return audits
+
+
+class ArchiveReader(object):
+    """
+    Reads the chunks of an archive directory. Their headers are read once, when the
+    reader is created.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.chunks = [
+            Chunk(os.path.join(directory, name))
+            for name in sorted(os.listdir(directory)) if name.endswith(CHUNK_SUFFIX)
+        ] if os.path.isdir(directory) else []
+
+    def find(self, content_type=None, object_id=None, since=None, until=None):
+        """
+        Returns the archived audits of a content type ("app_label.model" or a ContentType),
+        object id and date range [since, until), newest first.
+        """
+        if isinstance(content_type, ContentType):
+            content_type = content_type_label(content_type)
+        if object_id is not None and content_type is None:
+            raise ValueError("looking up an object id needs its content type")
+        audits = []
+        for chunk in self.chunks:
+            if chunk.may_contain(content_type, object_id, since, until):
+                audits.extend(chunk.audits(chunk.rows(content_type, object_id, since, until)))
+        audits.sort(key=lambda audit: (audit.date, audit.id), reverse=True)
+        return audits
+
+    def history(self, obj):
+        """
+        Returns the archived audits of obj, newest first, like AuditQuerySet.history.
+        """
+        return self.find(ContentType.objects.get_for_model(obj), obj.pk)
@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+"""
+Point-in-time reconstruction of audited objects.
+
+The state of an object at a date is rebuilt from its audits up to that date:
+an ADD holds all its (non null) fields, a CHANGE the fields it changed and a
+DELETE ends it. With DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL, the full state of
+an object is also written as an AuditCheckpoint after about every that many
+audits of it, and the reconstruction starts from the latest checkpoint before
+the date, so it replays a bounded number of changes however long the history
+of the object is.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import json
+import logging
+import re
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from . import settings
+from .models import Audit, AuditCheckpoint
+
+LOG = logging.getLogger(__name__)
+
+# the state of the audited object, kept on an unsaved audit until it is written
+STATE_ATTR = "_audit_checkpoint_state"
+
+
+def keep_state(audit, state):
+    """
+    Keeps the state of the object of an unsaved audit, to be written as its checkpoint if it
+    is due when the audit is written.
+    """
+    # passwords are masked, like in their changes (see signal.dict_diff)
+    setattr(audit, STATE_ATTR, dict(
+        (key, "*" * len(value) if value is not None and re.match(key, 'password') else value)
+        for key, value in state.items()
+    ))
+
+
+def write(entries, using):
+    """
+    Writes the checkpoints due after the written (audit, changes) entries, oldest first: an
+    audit of an object gets one when none of the DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL
+    latest audits of that object, itself included, has one. A failure is logged, the audits
+    are kept.
+    """
+    interval = settings.DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL
+    if not interval:
+        return
+    written = collections.OrderedDict()
+    for audit, changes in entries:
+        written.setdefault((audit.content_type_id, audit.object_id), []).append(audit)
+    if not any(getattr(audit, STATE_ATTR, None) is not None for audits in written.values() for audit in audits):
+        return
+
+    try:
+        with transaction.atomic(using=using):
+            # the checkpoints of the interval latest audits of every object before these ones, in one query
+            object_ids = collections.defaultdict(list)
+            for content_type_id, object_id in written:
+                object_ids[content_type_id].append(object_id)
+            condition = models.Q()
+            for content_type_id, ids in object_ids.items():
+                condition |= models.Q(content_type_id=content_type_id, object_id__in=ids)
+            latest = collections.defaultdict(list)
+            for content_type_id, object_id, checkpoint in Audit.objects.using(using).filter(condition).exclude(
+                    pk__in=[audit.pk for audits in written.values() for audit in audits]
+            ).annotate(
+                    rank=Window(RowNumber(), partition_by=[F("content_type_id"), F("object_id")],
+                                order_by=[F("date").desc(), F("id").desc()])
+            ).filter(rank__lte=interval).values_list("content_type_id", "object_id", "checkpoint"):
+                latest[(content_type_id, object_id)].append(checkpoint)
+
+            checkpoints = []
+            for key, audits in written.items():
+                content_type_id, object_id = key
+                # the latest audits without a checkpoint, up to interval
+                run = next((index for index, checkpoint in enumerate(latest[key]) if checkpoint is not None),
+                           len(latest[key]))
+                for audit in audits:
+                    run += 1
+                    if run >= interval and getattr(audit, STATE_ATTR, None) is not None:
+                        checkpoints.append(AuditCheckpoint(
+                            audit=audit,
+                            content_type_id=content_type_id,
+                            object_id=object_id,
+                            date=audit.date,
+                            state=json.dumps(getattr(audit, STATE_ATTR)),
+                        ))
+                        run = 0
+            if checkpoints:
+                AuditCheckpoint.objects.using(using).bulk_create(checkpoints)
+    except:
+        LOG.error(u'Error writing audit checkpoints', exc_info=True)
+
+
+def state_as_of(content_type, object_id, when, using=None):
+    """
+    Returns the audited fields of an object at the date when, as stored in its audits (text),
+    or None if it did not exist then, as far as its audits tell.
+    """
+    from .signal import get_plan
+
+    names = set(name for name, attname, converter in get_plan(content_type.model_class()))
+    checkpoint = AuditCheckpoint.objects.using(using).filter(
+        content_type=content_type, object_id=object_id, date__lte=when
+    ).order_by("-date", "-audit_id").first()
+
+    audits = Audit.objects.using(using).filter(content_type=content_type, object_id=object_id, date__lte=when)
+    if checkpoint is not None:
+        state = json.loads(checkpoint.state)
+        audits = audits.filter(
+            models.Q(date__gt=checkpoint.date) | models.Q(date=checkpoint.date, pk__gt=checkpoint.audit_id)
+        )
+    else:
+        state = None
+
+    for audit in audits.order_by("date", "id").prefetch_related("field_changes"):
+        if audit.operation == Audit.DELETE:
+            state = None
+            continue
+        if audit.operation == Audit.ADD or state is None:
+            # fields that were null when added have no change
+            state = dict((name, None) for name in names) if audit.operation == Audit.ADD else {}
+        for change in audit.field_changes.all():
+            if change.field in names:
+                state[change.field] = change.new_value
+    return state
+
+
+def as_of(obj, when, using=None):
+    """
+    Returns an unsaved instance of the model of obj with its audited fields at the date when,
+    or None if it did not exist then.
+    """
+    from .signal import from_text
+
+    model = obj.__class__
+    state = state_as_of(ContentType.objects.get_for_model(obj), obj.pk, when, using=using)
+    if state is None:
+        return None
+    instance = model()
+    for name, value in state.items():
+        field = model._meta.get_field(name)
+        setattr(instance, field.attname, from_text(field, value))
+    instance.pk = obj.pk
+    return instance
@@ -0,0 +1,96 @@
+# -*- coding:utf-8 -*-
+"""
+Streaming export of audits.
+
+The audits to export are read through QuerySet.iterator, a server-side cursor
+where the database has them, and their changes are read with one query per
+chunk of audits, so exporting any number of audits takes the memory of a
+single chunk. See the export_audits management command.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import csv
+import itertools
+import json
+
+from .models import Audit, AuditChange, describe_changes
+
+FIELDS = (
+    "id", "date", "operation", "content_type", "object_id", "obj_description", "description",
+    "user_id", "request_id", "path", "ip", "changes",
+)
+
+
+def rows(queryset, chunk_size=2000):
+    """
+    Yields the audits of queryset, in id order, as dicts of FIELDS where changes is a list
+    of (field, old_value, new_value).
+    """
+    operations = dict(Audit.OPERATION_CHOICES)
+    audits = queryset.order_by("pk").values_list(
+        "pk", "date", "operation", "content_type__app_label", "content_type__model", "object_id",
+        "obj_description", "description", "user_id", "request_id", "audit_request__path", "audit_request__ip",
+    ).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(itertools.islice(audits, chunk_size))
+        if not chunk:
+            return
+        changes = collections.defaultdict(list)
+        for audit_id, field, old_value, new_value in AuditChange.objects.using(queryset.db).filter(
+                audit_id__in=[audit[0] for audit in chunk]).order_by("pk").values_list(
+                "audit_id", "field", "old_value", "new_value"):
+            changes[audit_id].append((field, old_value, new_value))
+
+        for (pk, date, operation, app_label, model, object_id, obj_description, description,
+                user_id, request_id, path, ip) in chunk:
+            if not description and operation == Audit.CHANGE:
+                description = describe_changes(collections.OrderedDict(
+                    (field, (old_value, new_value)) for field, old_value, new_value in changes[pk]
+                ))
+            yield {
+                "id": pk,
+                "date": date.isoformat(),
+                "operation": str(operations[operation]),
+                "content_type": "%s.%s" % (app_label, model),
+                "object_id": str(object_id),
+                "obj_description": obj_description,
+                "description": str(description),
+                "user_id": user_id,
+                "request_id": request_id,
+                "path": path,
+                "ip": ip,
+                "changes": changes[pk],
+            }
+
+
+def write_csv(rows, out):
+    """
+    Writes rows as CSV, with their changes as a JSON list, and returns how many were written.
+    """
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    count = 0
+    for row in rows:
+        row["changes"] = json.dumps(row["changes"])
+        writer.writerow([row[field] for field in FIELDS])
+        count += 1
+    return count
+
+
+def write_jsonl(rows, out):
+    """
+    Writes rows as JSON lines and returns how many were written.
+    """
+    count = 0
+    for row in rows:
+        row["changes"] = [
+            {"field": field, "old_value": old_value, "new_value": new_value}
+            for field, old_value, new_value in row["changes"]
+        ]
+        out.write(json.dumps(row) + "\n")
+        count += 1
+    return count
+
+
+WRITERS = {"csv": write_csv, "jsonl": write_jsonl}
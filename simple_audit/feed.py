@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+"""
+Cached feed of the latest audits.
+
+When DJANGO_SIMPLE_AUDIT_FEED_CACHE is set, the latest
+DJANGO_SIMPLE_AUDIT_FEED_SIZE audits, and the latest audits of every user, are
+kept in that cache and read by the get_audit_log template tag instead of
+querying the audit table. A feed is read from the database once, when it is
+not in the cache, and then updated with the audits written (once their
+transaction committed). Two processes writing audits at the same time may drop
+some audits of each other from a feed, until it expires after
+DJANGO_SIMPLE_AUDIT_FEED_TIMEOUT seconds.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import logging
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import caches
+from django.db import transaction
+
+from . import settings
+from .models import Audit, AuditChange
+
+LOG = logging.getLogger(__name__)
+
+KEY_PREFIX = "simple_audit:feed:"
+
+
+def get_cache():
+    alias = settings.DJANGO_SIMPLE_AUDIT_FEED_CACHE
+    return caches[alias] if alias else None
+
+
+def get_key(user_id=None):
+    return KEY_PREFIX + ("all" if user_id is None else "user:%s" % user_id)
+
+
+def query(user_id=None):
+    """
+    Returns the audits of the feed of user_id (of everyone if None), newest first.
+    """
+    audits = Audit.objects.select_related('content_type')
+    if settings.DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES:
+        # for audit.get_description
+        audits = audits.prefetch_related('field_changes')
+    if user_id is not None:
+        audits = audits.filter(user_id=user_id)
+    return audits.order_by('-date', '-id')
+
+
+def feed_item(audit, changes):
+    """
+    Returns a copy of a written audit, without its request, to be kept in the feeds.
+    """
+    item = Audit(
+        pk=audit.pk, date=audit.date, operation=audit.operation, content_type_id=audit.content_type_id,
+        object_id=audit.object_id, description=audit.description, obj_description=audit.obj_description,
+        audit_request_id=audit.audit_request_id, user_id=audit.user_id, request_id=audit.request_id,
+    )
+    item.content_type = ContentType.objects.get_for_id(audit.content_type_id)
+    if not item.description and item.operation == Audit.CHANGE:
+        # as prefetch_related does, so get_description does not query the changes
+        field_changes = item.field_changes.all()
+        field_changes._result_cache = [
+            AuditChange(pk=change.pk, audit_id=audit.pk, field=change.field,
+                        old_value=change.old_value, new_value=change.new_value)
+            for change in changes
+        ]
+        field_changes._prefetch_done = True
+        item._prefetched_objects_cache = {'field_changes': field_changes}
+    return item
+
+
+def push(entries):
+    """
+    Adds written (audit, changes) entries to the feeds in the cache. Feeds not in the cache
+    are left alone, they are read from the database when they are needed.
+    """
+    cache = get_cache()
+    if cache is None:
+        return
+    try:
+        items = collections.defaultdict(list)
+        for audit, changes in entries:
+            item = feed_item(audit, changes)
+            items[get_key()].append(item)
+            if item.user_id is not None:
+                items[get_key(item.user_id)].append(item)
+        feeds = cache.get_many(list(items))
+        for key, feed in feeds.items():
+            # a feed read from the database after the audits were written already has them
+            merged = dict((audit.pk, audit) for audit in feed + items[key])
+            feeds[key] = sorted(
+                merged.values(), key=lambda audit: (audit.date, audit.pk), reverse=True
+            )[:settings.DJANGO_SIMPLE_AUDIT_FEED_SIZE]
+        if feeds:
+            cache.set_many(feeds, settings.DJANGO_SIMPLE_AUDIT_FEED_TIMEOUT)
+    except:
+        LOG.error(u'Error adding %d audits to the feeds', len(entries), exc_info=True)
+
+
+def written(entries, using):
+    """
+    Adds written entries to the feeds once the transaction that wrote them commits.
+    """
+    if get_cache() is not None:
+        transaction.on_commit(lambda: push(entries), using=using)
+
+
+def recent(limit, user_id=None):
+    """
+    Returns the limit latest audits of user_id (of everyone if None) from the cache, or None
+    when there is no feed cache or the feed is too short.
+    """
+    cache = get_cache()
+    if cache is None or limit > settings.DJANGO_SIMPLE_AUDIT_FEED_SIZE:
+        return None
+    key = get_key(user_id)
+    feed = cache.get(key)
+    if feed is None:
+        feed = list(query(user_id)[:settings.DJANGO_SIMPLE_AUDIT_FEED_SIZE])
+        cache.set(key, feed, settings.DJANGO_SIMPLE_AUDIT_FEED_TIMEOUT)
+    return feed[:limit]
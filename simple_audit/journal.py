@@ -0,0 +1,305 @@
+# -*- coding:utf-8 -*-
+"""
+Local append-only journal of audits.
+
+When DJANGO_SIMPLE_AUDIT_JOURNAL_DIR is set, audits are serialized as JSON lines
+and appended to segment files in that directory instead of being written to the
+database. Each process writes its own segment, named "<millis>-<pid>-<seq>.open"
+while it is being written and renamed to ".jsonl" once it is closed, which
+happens when it reaches DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_SIZE bytes, is older
+than DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_AGE seconds or the process exits.
+
+Closed segments are loaded into the database by the ingest_audit_journal
+management command (see ingest_segment). Audits registered inside a
+transaction are appended once it commits (see writer.on_commit_only).
+
+With DJANGO_SIMPLE_AUDIT_JOURNAL_FALLBACK, audits are still written to the
+database and only go to the journal when that write fails.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+import six
+from django.contrib.contenttypes.models import ContentType
+from django.db import router, transaction
+from django.utils.dateparse import parse_datetime
+
+from . import checkpoints, settings
+from .models import Audit, AuditChange, AuditJournalSegment, AuditRequest
+
+LOG = logging.getLogger(__name__)
+
+OPEN_SUFFIX = ".open"
+SEGMENT_SUFFIX = ".jsonl"
+
+FSYNC_ALWAYS = "always"
+FSYNC_SEGMENT = "segment"
+FSYNC_NEVER = "never"
+
+
+def serialize(audit, changes):
+    """
+    Returns the JSON line of an unsaved audit and its changes.
+    """
+    audit_request = audit.audit_request
+    if audit_request is not None:
+        user_id = audit_request.user_id
+        if user_id is None:
+            user = getattr(audit_request, '_user', None)
+            user_id = user.pk if user else None
+        audit_request = {
+            "request_id": audit_request.request_id,
+            "ip": audit_request.ip,
+            "path": audit_request.path,
+            "date": audit_request.date.isoformat(),
+            "user_id": user_id,
+        }
+    event = {
+        "date": audit.date.isoformat(),
+        "operation": audit.operation,
+        "content_type": list(audit.content_type.natural_key()),
+        "object_id": six.text_type(audit.object_id),
+        "description": six.text_type(audit.description),
+        "obj_description": audit.obj_description,
+        "request": audit_request,
+        "changes": [[change.field, change.old_value, change.new_value] for change in changes],
+    }
+    state = getattr(audit, checkpoints.STATE_ATTR, None)
+    if state is not None:
+        # to write its checkpoint when it is loaded, if one is due
+        event["state"] = state
+    return json.dumps(event) + "\n"
+
+
+class Journal(object):
+
+    def __init__(self, directory, segment_size, segment_age, fsync):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.sequence = 0
+        self.file = None
+        self.path = None
+        self.opened_at = None
+        self.timer = None
+
+    def append(self, entries):
+        data = "".join(serialize(audit, changes) for audit, changes in entries).encode("utf-8")
+        with self.lock:
+            if self.file is None or self.file.tell() >= self.segment_size \
+                    or time.time() - self.opened_at >= self.segment_age:
+                self._close()
+                self._open()
+            self.file.write(data)
+            self.file.flush()
+            if self.fsync == FSYNC_ALWAYS:
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.sequence += 1
+        name = "%013d-%d-%d" % (int(time.time() * 1000), self.pid, self.sequence)
+        self.path = os.path.join(self.directory, name)
+        self.file = open(self.path + OPEN_SUFFIX, "ab")
+        self.opened_at = time.time()
+        # closes the segment when it is too old even if nothing is appended anymore, so an
+        # idle process does not keep its audits out of reach of ingest_audit_journal
+        self.timer = threading.Timer(self.segment_age, self._expire, args=(self.path,))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _expire(self, path):
+        with self.lock:
+            if self.path == path and self.file is not None:
+                self._close()
+
+    def _close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.file is None:
+            return
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        os.rename(self.path + OPEN_SUFFIX, self.path + SEGMENT_SUFFIX)
+
+
+_lock = threading.Lock()
+_journal = None
+
+
+def get_journal():
+    """
+    Returns the journal of this process. A process forked from one that already
+    had a journal gets its own segments.
+    """
+    global _journal
+    with _lock:
+        if _journal is None or _journal.pid != os.getpid() \
+                or _journal.directory != settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR:
+            if _journal is not None and _journal.pid == os.getpid():
+                _journal.close()
+            _journal = Journal(
+                directory=settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR,
+                segment_size=settings.DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_SIZE,
+                segment_age=settings.DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_AGE,
+                fsync=settings.DJANGO_SIMPLE_AUDIT_JOURNAL_FSYNC,
+            )
+        return _journal
+
+
+def append(entries):
+    get_journal().append(entries)
+
+
+def close():
+    """
+    Closes the segment being written, so it can be ingested.
+    """
+    with _lock:
+        journal = _journal
+    if journal is not None and journal.pid == os.getpid():
+        journal.close()
+
+
+atexit.register(close)
+
+
+def list_segments(directory, include_open=False):
+    """
+    Returns the paths of the segments in directory, oldest first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    suffixes = (SEGMENT_SUFFIX, OPEN_SUFFIX) if include_open else (SEGMENT_SUFFIX,)
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith(suffixes)
+    ]
+
+
+def read_checkpoint(segment, using=None):
+    """
+    Returns the offset of segment up to which its audits were loaded.
+    """
+    offsets = AuditJournalSegment.objects.using(using or router.db_for_write(AuditJournalSegment))
+    return offsets.filter(name=os.path.basename(segment)).values_list("offset", flat=True).first() or 0
+
+
+def write_checkpoint(segment, offset, using=None):
+    """
+    Records that the audits of segment were loaded up to offset, in the current transaction.
+    """
+    offsets = AuditJournalSegment.objects.using(using or router.db_for_write(AuditJournalSegment))
+    offsets.update_or_create(name=os.path.basename(segment), defaults={"offset": offset})
+
+
+def forget_checkpoint(segment, using=None):
+    AuditJournalSegment.objects.using(using or router.db_for_write(AuditJournalSegment)).filter(
+        name=os.path.basename(segment)
+    ).delete()
+
+
+def load_events(events, using=None):
+    """
+    Writes deserialized journal events to the database, in one transaction.
+    """
+    from .writer import bulk_write
+
+    with transaction.atomic(using=using):
+        request_ids = dict(
+            (event["request"]["request_id"], event["request"]) for event in events if event["request"]
+        )
+        requests = dict(
+            AuditRequest.objects.using(using).filter(request_id__in=list(request_ids)).values_list("request_id", "pk")
+        )
+        missing = [
+            AuditRequest(
+                request_id=request_id,
+                ip=request["ip"],
+                path=request["path"],
+                date=parse_datetime(request["date"]),
+                user_id=request["user_id"],
+            )
+            for request_id, request in request_ids.items() if request_id not in requests
+        ]
+        if missing:
+            AuditRequest.objects.using(using).bulk_create(missing)
+            requests.update(
+                AuditRequest.objects.using(using).filter(
+                    request_id__in=[request.request_id for request in missing]
+                ).values_list("request_id", "pk")
+            )
+
+        entries = []
+        for event in events:
+            audit = Audit(
+                date=parse_datetime(event["date"]),
+                operation=event["operation"],
+                content_type=ContentType.objects.db_manager(using).get_by_natural_key(*event["content_type"]),
+                object_id=event["object_id"],
+                description=event["description"],
+                obj_description=event["obj_description"],
+                audit_request_id=requests[event["request"]["request_id"]] if event["request"] else None,
+                user_id=event["request"]["user_id"] if event["request"] else None,
+                request_id=event["request"]["request_id"] if event["request"] else None,
+            )
+            if event.get("state") is not None:
+                setattr(audit, checkpoints.STATE_ATTR, event["state"])
+            changes = [
+                AuditChange(field=field, old_value=old_value, new_value=new_value)
+                for field, old_value, new_value in event["changes"]
+            ]
+            entries.append((audit, changes))
+        bulk_write(entries, using=using)
+
+
+def ingest_segment(segment, batch_size=1000, using=None):
+    """
+    Loads a segment into the database in batches of batch_size audits, starting from its
+    checkpoint, and returns the number of audits loaded. The checkpoint is moved in the
+    transaction of every batch, so a batch is loaded once even if the ingestion crashes.
+    """
+    using = using or router.db_for_write(Audit)
+    offset = read_checkpoint(segment, using=using)
+    ingested = 0
+    with open(segment, "rb") as journal_file:
+        journal_file.seek(offset)
+        events = []
+        for line in journal_file:
+            if not line.endswith(b"\n"):
+                LOG.warning("ignoring incomplete last line of %s", segment)
+                break
+            events.append(json.loads(line.decode("utf-8")))
+            offset += len(line)
+            if len(events) >= batch_size:
+                load_batch(segment, events, offset, using)
+                ingested += len(events)
+                events = []
+        if events:
+            load_batch(segment, events, offset, using)
+            ingested += len(events)
+    return ingested
+
+
+def load_batch(segment, events, offset, using):
+    with transaction.atomic(using=using):
+        load_events(events, using=using)
+        write_checkpoint(segment, offset, using=using)
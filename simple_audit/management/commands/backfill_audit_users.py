@@ -0,0 +1,38 @@
+# -*- coding:utf-8 -*-
+from django.db import router, transaction
+from django.db.models import Max, Min, OuterRef, Subquery
+from django.core.management.base import BaseCommand
+
+from simple_audit.models import Audit, AuditRequest
+
+
+class Command(BaseCommand):
+    help = "Copies the user and request id of their request onto audits written before Audit had them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000,
+                            help="Range of audit ids updated per transaction.")
+        parser.add_argument("--database", default=None,
+                            help="Database to backfill.")
+
+    def handle(self, *args, **options):
+        using = options["database"] or router.db_for_write(Audit)
+        batch_size = options["batch_size"]
+        audits = Audit.objects.using(using).filter(audit_request__isnull=False, request_id__isnull=True)
+        bounds = audits.aggregate(first=Min("pk"), last=Max("pk"))
+        if bounds["first"] is None:
+            self.stdout.write("Nothing to backfill")
+            return
+
+        requests = AuditRequest.objects.using(using).filter(pk=OuterRef("audit_request_id"))
+        total = 0
+        # ranges of ids, so every batch is an index range scan whatever was backfilled before
+        for start in range(bounds["first"], bounds["last"] + 1, batch_size):
+            with transaction.atomic(using=using):
+                total += audits.filter(pk__gte=start, pk__lt=start + batch_size).update(
+                    user_id=Subquery(requests.values("user_id")[:1]),
+                    request_id=Subquery(requests.values("request_id")[:1]),
+                )
+            self.stdout.write("up to id %d: %d audits" % (min(start + batch_size, bounds["last"] + 1) - 1, total))
+
+        self.stdout.write("Backfilled %d audits" % total)
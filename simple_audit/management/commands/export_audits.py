@@ -0,0 +1,86 @@
+# -*- coding:utf-8 -*-
+import datetime
+import gzip
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from simple_audit import export
+from simple_audit.models import Audit
+
+OPERATIONS = {"add": Audit.ADD, "change": Audit.CHANGE, "delete": Audit.DELETE}
+
+
+def parse_moment(value):
+    moment = parse_datetime(value)
+    if moment is None:
+        date = parse_date(value)
+        if date is None:
+            raise CommandError("%r is not a date or a datetime" % value)
+        moment = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(moment) and timezone.is_aware(timezone.now()):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(BaseCommand):
+    help = "Exports audits, with their changes, as CSV or JSON lines, in constant memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", default="csv", choices=sorted(export.WRITERS))
+        parser.add_argument("--output", default="-",
+                            help="File to write, the standard output by default.")
+        parser.add_argument("--gzip", action="store_true",
+                            help="Compress the output file with gzip.")
+        parser.add_argument("--since", help="Export audits from this date or datetime on.")
+        parser.add_argument("--until", help="Export audits before this date or datetime.")
+        parser.add_argument("--content-type", action="append", default=[],
+                            help="Export the audits of this model (app_label.model_name), can be repeated.")
+        parser.add_argument("--user", help="Export the audits of the requests of this user (id or username).")
+        parser.add_argument("--operation", action="append", default=[], choices=sorted(OPERATIONS),
+                            help="Export audits of this operation, can be repeated.")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="Audits read per fetch, with their changes.")
+        parser.add_argument("--database", default=None,
+                            help="Database to export from.")
+
+    def handle(self, *args, **options):
+        audits = Audit.objects.db_manager(options["database"]).all()
+        if options["since"]:
+            audits = audits.filter(date__gte=parse_moment(options["since"]))
+        if options["until"]:
+            audits = audits.filter(date__lt=parse_moment(options["until"]))
+        if options["content_type"]:
+            audits = audits.filter(content_type__in=[
+                ContentType.objects.db_manager(options["database"]).get_for_model(apps.get_model(label))
+                for label in options["content_type"]
+            ])
+        if options["user"]:
+            audits = audits.filter(user=self.get_user(options["user"], options["database"]))
+        if options["operation"]:
+            audits = audits.filter(operation__in=[OPERATIONS[operation] for operation in options["operation"]])
+
+        rows = export.rows(audits, chunk_size=options["chunk_size"])
+        write = export.WRITERS[options["format"]]
+        if options["output"] == "-":
+            if options["gzip"]:
+                raise CommandError("--gzip needs an --output file.")
+            count = write(rows, self.stdout)
+        else:
+            opener = gzip.open if options["gzip"] else open
+            with opener(options["output"], "wt", encoding="utf-8", newline="") as out:
+                count = write(rows, out)
+            self.stderr.write("Exported %d audits" % count)
+
+    def get_user(self, value, using):
+        users = get_user_model()._default_manager.db_manager(using)
+        try:
+            if value.isdigit():
+                return users.get(pk=value)
+            return users.get_by_natural_key(value)
+        except users.model.DoesNotExist:
+            raise CommandError("No user %r" % value)
@@ -0,0 +1,40 @@
+# -*- coding:utf-8 -*-
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from simple_audit import journal, settings
+
+
+class Command(BaseCommand):
+    help = "Loads the audits appended to the journal (DJANGO_SIMPLE_AUDIT_JOURNAL_DIR) into the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dir", default=settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR,
+                            help="Journal directory, defaults to DJANGO_SIMPLE_AUDIT_JOURNAL_DIR.")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Audits written per transaction.")
+        parser.add_argument("--include-open", action="store_true",
+                            help="Also load segments still open, only safe when nothing writes to the journal.")
+        parser.add_argument("--keep", action="store_true",
+                            help="Rename loaded segments to .done instead of deleting them.")
+        parser.add_argument("--database", default=None,
+                            help="Database to load the audits into.")
+
+    def handle(self, *args, **options):
+        directory = options["dir"]
+        if not directory:
+            raise CommandError("No journal directory, set DJANGO_SIMPLE_AUDIT_JOURNAL_DIR or use --dir.")
+
+        total = 0
+        for segment in journal.list_segments(directory, include_open=options["include_open"]):
+            ingested = journal.ingest_segment(segment, batch_size=options["batch_size"], using=options["database"])
+            total += ingested
+            if options["keep"]:
+                os.rename(segment, segment + ".done")
+            else:
+                os.remove(segment)
+            journal.forget_checkpoint(segment, using=options["database"])
+            self.stdout.write("%s: %d audits" % (os.path.basename(segment), ingested))
+
+        self.stdout.write("Loaded %d audits" % total)
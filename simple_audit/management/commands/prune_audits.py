@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+import time
+
+from django.db import router
+from django.db.models import Max, Min
+from django.core.management.base import BaseCommand, CommandError
+
+from simple_audit import retention
+from simple_audit.models import Audit
+
+
+class Command(BaseCommand):
+    help = "Deletes, or archives, the audits older than their retention period (DJANGO_SIMPLE_AUDIT_RETENTION)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Range of audit ids deleted per transaction.")
+        parser.add_argument("--sleep", type=float, default=0,
+                            help="Seconds to wait between batches, to leave room to the application.")
+        parser.add_argument("--archive-dir", default=None,
+                            help="Directory where the audits are archived before being deleted.")
+        parser.add_argument("--archive-format", default=retention.ARCHIVE_JSONL,
+                            choices=(retention.ARCHIVE_JSONL, retention.ARCHIVE_COLUMNAR),
+                            help="Gzipped journal lines, or chunks of the columnar archive (see simple_audit.archive).")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only count the expired audits.")
+        parser.add_argument("--database", default=None,
+                            help="Database to prune.")
+
+    def handle(self, *args, **options):
+        using = options["database"] or router.db_for_write(Audit)
+        batch_size = options["batch_size"]
+        audits = retention.expired(using=using)
+        if audits is None:
+            raise CommandError("No retention period, set DJANGO_SIMPLE_AUDIT_RETENTION.")
+        if options["dry_run"]:
+            self.stdout.write("%d audits expired" % audits.count())
+            return
+
+        # pruned audits are gone, so a run that was interrupted resumes from the first one left
+        bounds = audits.aggregate(first=Min("pk"), last=Max("pk"))
+        if bounds["first"] is None:
+            self.stdout.write("Nothing to prune")
+            return
+
+        total = 0
+        for start in range(bounds["first"], bounds["last"] + 1, batch_size):
+            batch = audits.filter(pk__gte=start, pk__lt=start + batch_size)
+            total += retention.prune_batch(batch, using=using, archive_dir=options["archive_dir"],
+                                           archive_format=options["archive_format"])
+            self.stdout.write("up to id %d: %d audits" % (min(start + batch_size, bounds["last"] + 1) - 1, total))
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        self.stdout.write("Pruned %d audits" % total)
@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+from django.db import router, transaction
+from django.db.models import Max, Min
+from django.core.management.base import BaseCommand, CommandError
+
+from simple_audit import search
+from simple_audit.models import Audit
+
+
+class Command(BaseCommand):
+    help = ("Creates the full-text search index of audits, unless it exists, and (re)indexes the audits "
+            "already written. Audits written meanwhile keep being indexed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Range of audit ids indexed per transaction.")
+        parser.add_argument("--database", default=None,
+                            help="Database to index.")
+
+    def handle(self, *args, **options):
+        backend = search.get_backend()
+        if backend is None:
+            raise CommandError("DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND is not set")
+
+        using = options["database"] or router.db_for_write(Audit)
+        batch_size = options["batch_size"]
+        backend.create(using)
+
+        audits = Audit.objects.using(using).prefetch_related("field_changes")
+        bounds = audits.aggregate(first=Min("pk"), last=Max("pk"))
+        if bounds["first"] is None:
+            self.stdout.write("Nothing to index")
+            return
+
+        total = 0
+        for start in range(bounds["first"], bounds["last"] + 1, batch_size):
+            batch = audits.filter(pk__gte=start, pk__lt=start + batch_size)
+            entries = [(audit, audit.field_changes.all()) for audit in batch]
+            with transaction.atomic(using=using):
+                backend.index(entries, using)
+            total += len(entries)
+            self.stdout.write("up to id %d: %d audits" % (min(start + batch_size, bounds["last"] + 1) - 1, total))
+
+        self.stdout.write("Indexed %d audits" % total)
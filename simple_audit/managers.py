@@ -1,7 +1,9 @@
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
 from django.db.models.query import QuerySet
 
+from . import settings
+
 
 class AuditQuerySet(QuerySet):
     def _get_content_type(self, obj):
@@ -13,6 +15,39 @@ class AuditQuerySet(QuerySet):
             object_id=obj.id
         )
 
+    def search(self, query):
+        """
+        Audits whose description, object description or changes match query, from the full-text
+        index of DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND, or with icontains when there is none.
+        """
+        from . import search
+
+        backend = search.get_backend()
+        if backend is not None:
+            return backend.filter(self, query)
+        return self.filter(
+            models.Q(description__icontains=query) | models.Q(obj_description__icontains=query)
+        )
+
+    def history(self, obj):
+        """
+        Audits of obj, newest first. The filter and the ordering are both covered by the
+        audit_history_idx index, so the database reads them in order without sorting.
+        """
+        return self.filter(
+            content_type=self._get_content_type(obj),
+            object_id=obj.pk
+        ).order_by("-date", "-id")
+
+    def as_of(self, obj, when):
+        """
+        An unsaved instance of the model of obj with its audited fields at the date when, or
+        None if it did not exist then, see checkpoints.py.
+        """
+        from . import checkpoints
+
+        return checkpoints.as_of(obj, when, using=self.db)
+
 
 class AuditManager(models.Manager):
     def get_query_set(self):
@@ -26,3 +61,221 @@ class AuditManager(models.Manager):
         if attr.startswith("_"):
             raise AttributeError
         return getattr(self.get_queryset(), attr, *args)
+
+
+class AuditedQuerySetMixin(object):
+    """
+    Audits the bulk operations of a registered model, which do not send the signals
+    the per-instance auditing relies on. The old states of the whole batch are read
+    in one query, and all audits are written in bulk.
+
+    Use AuditedManager, or mix this into the custom QuerySet of the model.
+    """
+    _skip_audit = False
+
+    def _clone(self):
+        clone = super(AuditedQuerySetMixin, self)._clone()
+        clone._skip_audit = self._skip_audit
+        return clone
+
+    def _is_audited(self):
+        from . import signal
+        return not self._skip_audit and self.model in signal.MODEL_LIST
+
+    def _persist(self, entries):
+        from . import signal, writer
+
+        try:
+            writer.persist_many(entries)
+        except:
+            signal.LOG.error(u'Error registering auditing of %d %s', len(entries), self.model.__name__,
+                             exc_info=True)
+
+    def _audit_changes(self, old_objs, new_objs):
+        from . import signal
+        from .models import Audit
+
+        entries = []
+        for pk, old_obj in old_objs.items():
+            new_obj = new_objs.get(pk)
+            if new_obj is None:
+                continue
+            changed_fields = signal.dict_diff(signal.to_dict(old_obj), signal.to_dict(new_obj))
+            if changed_fields:
+                entries.append(signal.build_audit(
+                    new_obj, signal.describe(new_obj, Audit.CHANGE, changed_fields), Audit.CHANGE, changed_fields
+                ))
+        return entries
+
+    def _audit_states(self, objs, operation):
+        """ audits objs as added or deleted, with all their fields """
+        from . import signal
+
+        entries = []
+        for obj in objs:
+            changed_fields = signal.dict_diff({}, signal.to_dict(obj))
+            entries.append(signal.build_audit(obj, signal.describe(obj, operation), operation, changed_fields))
+        return entries
+
+    def update(self, **kwargs):
+        if not self._is_audited():
+            return super(AuditedQuerySetMixin, self).update(**kwargs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            old_objs = dict((obj.pk, obj) for obj in self._chain())
+            rows = super(AuditedQuerySetMixin, self).update(**kwargs)
+            new_objs = self.model._base_manager.db_manager(self.db).in_bulk(list(old_objs))
+            self._persist(self._audit_changes(old_objs, new_objs))
+        return rows
+
+    update.alters_data = True
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        if not self._is_audited():
+            return super(AuditedQuerySetMixin, self).bulk_update(objs, fields, batch_size=batch_size)
+        from . import signal
+
+        objs = list(objs)
+        pks = [obj.pk for obj in objs]
+        base_manager = self.model._base_manager.db_manager(self.db)
+        # bulk_update runs update() for each batch, those are audited here at once
+        queryset = self._chain()
+        queryset._skip_audit = True
+        with transaction.atomic(using=self.db, savepoint=False):
+            old_objs = base_manager.in_bulk(pks)
+            rows = super(AuditedQuerySetMixin, queryset).bulk_update(objs, fields, batch_size=batch_size)
+            new_objs = base_manager.in_bulk(pks)
+            self._persist(self._audit_changes(old_objs, new_objs))
+        if settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS:
+            for obj in objs:
+                if obj.pk in new_objs:
+                    obj.__dict__[signal.SNAPSHOT_ATTR] = signal.take_snapshot(new_objs[obj.pk])
+        return rows
+
+    bulk_update.alters_data = True
+
+    def _unique_keys(self, unique_fields=None):
+        """ the field sets a row can conflict on: unique_fields, or every unique constraint """
+        opts = self.model._meta
+        if unique_fields:
+            key_sets = [[opts.pk.name if name == "pk" else name for name in unique_fields]]
+        else:
+            key_sets = [[field.name] for field in opts.concrete_fields if field.unique]
+            key_sets += [list(fields) for fields in opts.unique_together]
+            key_sets += [list(constraint.fields) for constraint in opts.total_unique_constraints]
+        return [tuple(opts.get_field(name).attname for name in key_set) for key_set in key_sets]
+
+    def _keys_of(self, obj, key_sets):
+        """ the unique keys of obj, those with a null value do not conflict """
+        keys = []
+        for attnames in key_sets:
+            values = tuple(getattr(obj, attname) for attname in attnames)
+            if None not in values:
+                keys.append((attnames, values))
+        return keys
+
+    def _rows_for(self, keys):
+        """ the rows with one of keys, by key """
+        condition = models.Q()
+        for attnames, values in keys:
+            condition |= models.Q(**dict(zip(attnames, values)))
+        rows = {}
+        if keys:
+            key_sets = set(attnames for attnames, values in keys)
+            for row in self.model._base_manager.db_manager(self.db).filter(condition):
+                for key in self._keys_of(row, key_sets):
+                    rows[key] = row
+        return rows
+
+    def _bulk_create_on_conflict(self, objs, *args, **kwargs):
+        """
+        bulk_create with ignore_conflicts or update_conflicts: the rows the objects conflict
+        with are read before and after the insert, so an ignored object is not audited, an
+        updated row is audited as changed and only the inserted rows are audited as added.
+        """
+        from . import signal
+        from .models import Audit
+
+        objs = list(objs)
+        update = kwargs.get("update_conflicts")
+        key_sets = self._unique_keys(kwargs.get("unique_fields") if update else None)
+        obj_keys = [self._keys_of(obj, key_sets) for obj in objs]
+        with transaction.atomic(using=self.db, savepoint=False):
+            old_rows = self._rows_for(set(key for keys in obj_keys for key in keys))
+            objs = super(AuditedQuerySetMixin, self).bulk_create(objs, *args, **kwargs)
+            # the primary key may now be known, when it is not one of the unique keys
+            obj_keys = [keys + self._keys_of(obj, [(self.model._meta.pk.attname,)])
+                        for obj, keys in zip(objs, obj_keys)]
+            new_rows = self._rows_for(set(key for keys in obj_keys for key in keys))
+
+            old_objs, new_objs, added, unknown = {}, {}, {}, 0
+            for obj, keys in zip(objs, obj_keys):
+                old_row = next((old_rows[key] for key in keys if key in old_rows), None)
+                new_row = next((new_rows[key] for key in keys if key in new_rows), None)
+                if old_row is not None:
+                    if update and new_row is not None:
+                        old_objs[old_row.pk], new_objs[new_row.pk] = old_row, new_row
+                elif new_row is not None:
+                    added[new_row.pk] = new_row
+                else:
+                    unknown += 1
+            if unknown:
+                signal.LOG.warning("%d %s created in bulk were not audited, their primary key is unknown",
+                                   unknown, self.model.__name__)
+            self._persist(self._audit_states(list(added.values()), Audit.ADD)
+                          + self._audit_changes(old_objs, new_objs))
+        if settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS:
+            for obj in objs:
+                row = added.get(obj.pk, new_objs.get(obj.pk))
+                if row is not None:
+                    obj.__dict__[signal.SNAPSHOT_ATTR] = signal.take_snapshot(row)
+        return objs
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        Audits the created objects as added. Objects whose primary key is not known after the
+        insert (databases that can not return it) are not audited. With ignore_conflicts or
+        update_conflicts, see _bulk_create_on_conflict.
+        """
+        if not self._is_audited():
+            return super(AuditedQuerySetMixin, self).bulk_create(objs, *args, **kwargs)
+        if kwargs.get("ignore_conflicts") or kwargs.get("update_conflicts"):
+            return self._bulk_create_on_conflict(objs, *args, **kwargs)
+        objs = super(AuditedQuerySetMixin, self).bulk_create(objs, *args, **kwargs)
+        from . import signal
+        from .models import Audit
+
+        created = [obj for obj in objs if obj.pk is not None]
+        if len(created) < len(objs):
+            signal.LOG.warning("%d %s created in bulk were not audited, their primary key is unknown",
+                               len(objs) - len(created), self.model.__name__)
+        self._persist(self._audit_states(created, Audit.ADD))
+        if settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS:
+            for obj in created:
+                obj.__dict__[signal.SNAPSHOT_ATTR] = signal.take_snapshot(obj)
+        return objs
+
+    bulk_create.alters_data = True
+
+    def delete(self):
+        if not self._is_audited():
+            return super(AuditedQuerySetMixin, self).delete()
+        from . import signal
+        from .models import Audit
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = list(self._chain())
+            entries = self._audit_states(objs, Audit.DELETE)
+            with signal.skip_delete_audits(self.model, [obj.pk for obj in objs]):
+                deleted = super(AuditedQuerySetMixin, self).delete()
+            self._persist(entries)
+        return deleted
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class AuditedQuerySet(AuditedQuerySetMixin, QuerySet):
+    pass
+
+
+AuditedManager = models.Manager.from_queryset(AuditedQuerySet)
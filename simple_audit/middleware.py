@@ -1,9 +1,25 @@
-# threadlocals middleware
-from django.utils.deprecation import MiddlewareMixin
+# request context middleware
+import asyncio
+import logging
+import random
+import re
+
 from django.utils.functional import SimpleLazyObject
 
 from .models import AuditRequest
-from . import settings
+from . import settings, writer
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6
+    from asyncio import iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+LOG = logging.getLogger(__name__)
 
 
 def get_actual_user(request):
@@ -11,9 +27,101 @@ def get_actual_user(request):
         return request.user
 
 
-class TrackingRequestOnThreadLocalMiddleware(MiddlewareMixin):
+def compile_patterns(patterns):
+    """
+    Compiles path regular expressions into a single one, or returns None if there are none.
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join("(?:%s)" % pattern for pattern in patterns))
+
+
+class RequestPolicy(object):
+    """
+    Decides which requests are tracked, from the path patterns and methods of the
+    settings, compiled once:
+
+    * paths matching exclude_paths are never tracked;
+    * paths matching include_paths are tracked whatever their method;
+    * other requests are tracked unless their method is in skip_methods;
+    * a tracked request whose path matches a pattern of sampling is only tracked with
+      the probability of the first pattern it matches.
+    """
+
+    def __init__(self, skip_methods=(), include_paths=(), exclude_paths=(), sampling=()):
+        self.skip_methods = frozenset(method.upper() for method in skip_methods)
+        self.include = compile_patterns(include_paths)
+        self.exclude = compile_patterns(exclude_paths)
+        sampling = list(sampling.items() if isinstance(sampling, dict) else sampling)
+        self.rates = [rate for pattern, rate in sampling]
+        self.sampling = re.compile("|".join(
+            "(?P<rate%d>%s)" % (index, pattern) for index, (pattern, rate) in enumerate(sampling)
+        )) if sampling else None
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            skip_methods=settings.DJANGO_SIMPLE_AUDIT_SKIP_METHODS,
+            include_paths=settings.DJANGO_SIMPLE_AUDIT_INCLUDE_PATHS,
+            exclude_paths=settings.DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS,
+            sampling=settings.DJANGO_SIMPLE_AUDIT_SAMPLING,
+        )
+
+    def should_track(self, request):
+        path = request.path_info
+        if self.exclude is not None and self.exclude.match(path):
+            return False
+        if request.method in self.skip_methods and not (self.include is not None and self.include.match(path)):
+            return False
+        if self.sampling is not None:
+            match = self.sampling.match(path)
+            if match is not None:
+                return random.random() < self.rates[int(match.lastgroup[len("rate"):])]
+        return True
+
+
+class TrackingRequestOnThreadLocalMiddleware(object):
     """Middleware that gets various objects from the
-    request object and saves them in thread local storage."""
+    request object and saves them in the context of the request (a contextvar,
+    so concurrent async requests served by one thread do not share it).
+    It runs natively under both WSGI and ASGI."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.policy = RequestPolicy.from_settings()
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.policy.should_track(request):
+            self.skip_request()
+            return self.get_response(request)
+        self.process_request(request)
+        try:
+            response = self.get_response(request)
+        except:
+            self.end_request(request, failed=True)
+            raise
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        if not self.policy.should_track(request):
+            self.skip_request()
+            return await self.get_response(request)
+        self.process_request(request)
+        try:
+            response = await self.get_response(request)
+        except:
+            await self.aend_request(request, failed=True)
+            raise
+        await self.aend_request(request, failed=getattr(request, '_simple_audit_failed', False) or response.status_code >= 500)
+        return response
 
     def _get_ip(self, request):
         # get real ip
@@ -29,13 +137,35 @@ class TrackingRequestOnThreadLocalMiddleware(MiddlewareMixin):
         return ip
 
     def process_request(self, request):
-        if request.method == "GET":
-            return
-
         ip = self._get_ip(request)
         user = SimpleLazyObject(lambda: get_actual_user(request))
         AuditRequest.new_request(request.get_full_path(), user, ip)
+        if settings.DJANGO_SIMPLE_AUDIT_REQUEST_BUFFER:
+            writer.start_request_buffer()
 
-    def process_response(self, request, response):
+    def skip_request(self):
+        # an untracked request gets no audit request, nor one left in the context by a previous request
+        writer.end_request_buffer(discard=True)
         AuditRequest.cleanup_request()
+
+    def process_exception(self, request, exception):
+        request._simple_audit_failed = True
+
+    def process_response(self, request, response):
+        # the audits of a failed view are not written
+        self.end_request(request, failed=getattr(request, '_simple_audit_failed', False) or response.status_code >= 500)
         return response
+
+    def end_request(self, request, failed=False):
+        try:
+            writer.end_request_buffer(discard=failed)
+        except:
+            LOG.error(u'Error writing the audits of request %s', request.get_full_path(), exc_info=True)
+        AuditRequest.cleanup_request()
+
+    async def aend_request(self, request, failed=False):
+        try:
+            await writer.aend_request_buffer(discard=failed)
+        except:
+            LOG.error(u'Error writing the audits of request %s', request.get_full_path(), exc_info=True)
+        AuditRequest.cleanup_request()
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.10 on 2026-10-18 07:58
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_audit', '0004_audit_date_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='auditrequest',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Date'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.10 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+from simple_audit.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # the indexes are built concurrently on PostgreSQL, see simple_audit/operations.py
+    atomic = False
+
+    dependencies = [
+        ('simple_audit', '0005_auditrequest_date_default'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='audit',
+            index=models.Index(fields=['content_type', 'object_id', 'date', 'id'], name='audit_history_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='audit',
+            index=models.Index(fields=['date'], name='audit_date_idx'),
+        ),
+    ]
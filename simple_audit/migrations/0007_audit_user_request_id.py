@@ -0,0 +1,38 @@
+# Generated by Django 4.2.10 on 2026-10-18 08:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from simple_audit.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # the indexes are built concurrently on PostgreSQL, see simple_audit/operations.py
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('simple_audit', '0006_audit_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audit',
+            name='request_id',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='audit',
+            name='user',
+            field=models.ForeignKey(blank=True, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        AddIndexConcurrently(
+            model_name='audit',
+            index=models.Index(fields=['user', 'date'], name='audit_user_date_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='audit',
+            index=models.Index(fields=['request_id'], name='audit_request_id_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.10 on 2026-10-18 08:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('simple_audit', '0007_audit_user_request_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.UUIDField()),
+                ('date', models.DateTimeField()),
+                ('state', models.TextField()),
+                ('audit', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoint', to='simple_audit.audit')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+            ],
+            options={
+                'verbose_name': 'Audit checkpoint',
+                'verbose_name_plural': 'Audit checkpoints',
+                'db_table': 'audit_checkpoint',
+                'indexes': [models.Index(fields=['content_type', 'object_id', 'date'], name='audit_checkpoint_idx')],
+            },
+        ),
+    ]
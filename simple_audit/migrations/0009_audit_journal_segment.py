@@ -0,0 +1,26 @@
+# Generated by Django 4.2.10 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simple_audit', '0008_audit_checkpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditJournalSegment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('offset', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Audit journal segment',
+                'verbose_name_plural': 'Audit journal segments',
+                'db_table': 'audit_journal_segment',
+            },
+        ),
+    ]
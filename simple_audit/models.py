@@ -1,19 +1,53 @@
 # -*- coding:utf-8 -*-
 
+import contextvars
 import logging
-import threading
 import uuid
 
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from .managers import AuditManager
 
 LOG = logging.getLogger(__name__)
 
+# the request being audited, per thread and per asyncio task
+CURRENT_REQUEST = contextvars.ContextVar("simple_audit_current_request", default=None)
+
+
+def describe_object(obj):
+    """
+    Returns the description of an audited object, from its get_audit_description method if
+    it has one, otherwise str(obj), truncated to fit Audit.obj_description.
+    """
+    if obj is None:
+        return ""
+    get_audit_description = getattr(obj, "get_audit_description", None)
+    description = get_audit_description() if get_audit_description is not None else str(obj)
+    return description[:100]
+
+
+def format_value(v):
+    if isinstance(v, str):
+        return "'{}'".format(v)
+    return str(v)
+
+
+def describe_changes(changed_fields):
+    return u"\n".join([u"%s %s: %s %s %s %s" %
+        (
+            _("field"),
+            k,
+            _("was changed from"),
+            format_value(v[0]),
+            _("to"),
+            format_value(v[1]),
+        ) for k, v in changed_fields.items()])
+
 
 class CustomAppName(str):
     def __new__(cls, value, title):
@@ -24,6 +58,10 @@ class CustomAppName(str):
     def title(self):
         return self._title
 
+    def __reduce__(self):
+        # pickled audits (in a cache) only need the app label to find their model
+        return (str, (str(self),))
+
     def __copy__(self):
         return self
 
@@ -36,7 +74,8 @@ class Audit(models.Model):
     CHANGE = 1
     DELETE = 2
     OPERATION_CHOICES = ((ADD, _("add")), (CHANGE, _("change")), (DELETE, _("delete")))
-    date = models.DateTimeField(auto_now_add=True, verbose_name=_("Date"))
+    # set when the audit is registered, it may be written later (see writer.py)
+    date = models.DateTimeField(default=timezone.now, editable=False, verbose_name=_("Date"))
     operation = models.PositiveIntegerField(
         choices=OPERATION_CHOICES, verbose_name=_("Operation")
     )
@@ -46,6 +85,13 @@ class Audit(models.Model):
     audit_request = models.ForeignKey(
         "AuditRequest", null=True, on_delete=models.SET_NULL
     )
+    # copied from audit_request when the audit is written, to filter without joining it
+    user = models.ForeignKey(
+        getattr(settings, "AUTH_USER_MODEL", "auth.User"),
+        null=True, blank=True, editable=False, db_index=False,
+        on_delete=models.SET_NULL, related_name="+"
+    )
+    request_id = models.CharField(max_length=255, null=True, blank=True, editable=False)
     description = models.TextField()
     obj_description = models.CharField(
         max_length=100, db_index=True, null=True, blank=True
@@ -62,18 +108,56 @@ class Audit(models.Model):
         app_label = CustomAppName("simple_audit", _("Audits"))
         verbose_name = _("Audit")
         verbose_name_plural = _("Audits")
+        indexes = [
+            # the history of an object, newest first (see AuditQuerySet.history)
+            models.Index(fields=["content_type", "object_id", "date", "id"], name="audit_history_idx"),
+            # listings, newest first
+            models.Index(fields=["date"], name="audit_date_idx"),
+            # what a user did, newest first
+            models.Index(fields=["user", "date"], name="audit_user_date_idx"),
+            models.Index(fields=["request_id"], name="audit_request_id_idx"),
+        ]
 
     @staticmethod
-    def register(audit_obj, description, operation=None):
+    def register(audit_obj, description, operation=None, commit=True):
         audit = Audit()
         audit.operation = Audit.CHANGE if operation is None else operation
-        audit.content_object = audit_obj
+        # not content_object: an audit written later (see writer.py) must not keep the
+        # instance, whose pk is cleared when it is deleted
+        audit.content_type = ContentType.objects.get_for_model(audit_obj)
+        audit.object_id = audit_obj.pk
         audit.description = description
-        audit.obj_description = (audit_obj and str(audit_obj) and "")[:100]
-        audit.audit_request = AuditRequest.current_request(True)
-        audit.save()
+        audit.obj_description = describe_object(audit_obj)
+        audit.audit_request = AuditRequest.current_request(commit)
+        if audit.audit_request is not None:
+            audit.request_id = audit.audit_request.request_id
+        if commit:
+            audit.denormalize_request()
+            audit.save()
         return audit
 
+    def denormalize_request(self):
+        """
+        Copies the user of the saved audit request onto the audit.
+        """
+        if self.audit_request_id is not None and Audit.audit_request.is_cached(self):
+            self.user_id = self.audit_request.user_id
+            self.request_id = self.audit_request.request_id
+
+    def get_description(self):
+        """
+        Returns the description of the audit. The description of a change is rendered from
+        its field changes, in the active language, when it was not stored (see
+        DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES). Prefetch field_changes to render many.
+        """
+        if self.description or self.operation != Audit.CHANGE:
+            return self.description
+        return describe_changes(dict(
+            (change.field, (change.old_value, change.new_value))
+            for change in sorted(self.field_changes.all(), key=lambda change: change.pk)
+        ))
+    get_description.short_description = _("Description")
+
     def __str__(self):
         return u"{}".format(self.operation)
 
@@ -93,14 +177,52 @@ class AuditChange(models.Model):
         verbose_name_plural = _("Audits")
 
 
-class AuditRequest(models.Model):
+class AuditCheckpoint(models.Model):
+    """
+    The full state of an audited object after an audit, written every
+    DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL audits of the object (see checkpoints.py).
+    """
+    audit = models.OneToOneField(
+        Audit, on_delete=models.CASCADE, related_name="checkpoint"
+    )
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.UUIDField()
+    date = models.DateTimeField()
+    # the audited fields, as stored in AuditChange, in JSON
+    state = models.TextField()
+
+    class Meta:
+        db_table = "audit_checkpoint"
+        app_label = CustomAppName("simple_audit", _("Audits"))
+        verbose_name = _("Audit checkpoint")
+        verbose_name_plural = _("Audit checkpoints")
+        indexes = [
+            # the latest checkpoint of an object before a date (see checkpoints.state_as_of)
+            models.Index(fields=["content_type", "object_id", "date"], name="audit_checkpoint_idx"),
+        ]
+
+
+class AuditJournalSegment(models.Model):
+    """
+    How far a journal segment was loaded into the database, written in the transaction
+    that loads each batch of its audits (see journal.ingest_segment).
+    """
+    name = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
 
-    THREAD_LOCAL = threading.local()
+    class Meta:
+        db_table = "audit_journal_segment"
+        app_label = CustomAppName("simple_audit", _("Audits"))
+        verbose_name = _("Audit journal segment")
+        verbose_name_plural = _("Audit journal segments")
+
+
+class AuditRequest(models.Model):
 
     request_id = models.CharField(max_length=255, db_index=True)
     ip = models.GenericIPAddressField()
     path = models.CharField(max_length=1024)
-    date = models.DateTimeField(auto_now_add=True, verbose_name=_("Date"))
+    date = models.DateTimeField(default=timezone.now, editable=False, verbose_name=_("Date"))
     user = models.ForeignKey(
         getattr(settings, "AUTH_USER_MODEL", "auth.User"), 
         on_delete=models.SET_NULL, 
@@ -116,7 +238,7 @@ class AuditRequest(models.Model):
     @staticmethod
     def new_request(path, user, ip):
         """
-        Create a new request from a path, user and ip and put it on thread context.
+        Create a new request from a path, user and ip and put it on the current context.
         The new request should not be saved until first use or calling method current_request(True)
         """
         audit_request = AuditRequest()
@@ -125,13 +247,13 @@ class AuditRequest(models.Model):
         audit_request.request_id = uuid.uuid4().hex
         setattr(audit_request, '_user', user)
 
-        AuditRequest.THREAD_LOCAL.current = audit_request
+        CURRENT_REQUEST.set(audit_request)
         return audit_request
 
     @staticmethod
     def set_request_from_id(request_id):
-        """ Load an old request from database and put it again in thread context. If request_id doesn't
-        exist, thread context will be cleared """
+        """ Load an old request from database and put it again in the current context. If request_id doesn't
+        exist, the context will be cleared """
         audit_request = None
         if request_id is not None:
             try:
@@ -139,24 +261,29 @@ class AuditRequest(models.Model):
             except AuditRequest.DoesNotExist:
                 pass
 
-        AuditRequest.THREAD_LOCAL.current = audit_request
+        CURRENT_REQUEST.set(audit_request)
 
     @staticmethod
     def current_request(force_save=False):
-        """ Get current request from thread context (or None doesn't exist). If you specify force_save,
+        """ Get current request from the current context (or None doesn't exist). If you specify force_save,
         current request will be saved on database first.
         """
-        audit_request = getattr(AuditRequest.THREAD_LOCAL, "current", None)
-        if force_save and audit_request is not None and audit_request.pk is None:
-            user = getattr(audit_request, '_user')
-            if user:
-                audit_request.user = user
-            audit_request.save()
+        audit_request = CURRENT_REQUEST.get()
+        if force_save and audit_request is not None:
+            audit_request.ensure_saved()
         return audit_request
 
+    def ensure_saved(self, using=None):
+        """ Save request on database with its user, unless it was already saved """
+        if self.pk is None:
+            user = getattr(self, '_user', None)
+            if user:
+                self.user = user
+            self.save(using=using)
+
     @staticmethod
     def cleanup_request():
         """
-        Remove audit request from thread context
+        Remove audit request from the current context
         """
-        AuditRequest.THREAD_LOCAL.current = None
+        CURRENT_REQUEST.set(None)
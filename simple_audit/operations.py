@@ -0,0 +1,34 @@
+# -*- coding:utf-8 -*-
+"""
+Migration operations.
+
+AddIndexConcurrently builds the index CONCURRENTLY on PostgreSQL, so adding an
+index to a large audit table does not block the writes to it, and is a plain
+AddIndex on the other databases. django.contrib.postgres is not imported, it
+needs a PostgreSQL driver. The migrations using it are not atomic, PostgreSQL
+can not build an index concurrently in a transaction.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from django.db import migrations
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super(AddIndexConcurrently, self).database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super(AddIndexConcurrently, self).database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+    def describe(self):
+        return "Create index %s on field(s) %s of model %s, concurrently on PostgreSQL" % (
+            self.index.name, ", ".join(self.index.fields), self.model_name)
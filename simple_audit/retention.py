@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+"""
+Retention of audits.
+
+DJANGO_SIMPLE_AUDIT_RETENTION maps audited models ("app_label.model_name") to
+the number of days their audits are kept, "*" being the default for the other
+models and None keeping them forever. The prune_audits management command
+deletes the expired audits, their changes and the audit requests left without
+audits, in batches of primary keys: every batch is a transaction of its own, so
+the tables are never locked for long, and an interrupted run resumes where it
+stopped when run again.
+
+With an archive directory, every batch is first written there, as journal
+lines (see write_archive) or as a chunk of the columnar archive of archive.py,
+so audits can be moved out of the database instead of lost.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import logging
+import os
+from datetime import timedelta
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.utils import timezone
+
+from . import archive, journal, search, settings
+from .models import Audit, AuditRequest
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT = "*"
+
+ARCHIVE_JSONL = "jsonl"
+ARCHIVE_COLUMNAR = "columnar"
+
+
+def get_policies(retention=None):
+    """
+    Returns the retention policies as a dict of content type (None for the default) to
+    days kept, or None to keep them forever.
+    """
+    if retention is None:
+        retention = settings.DJANGO_SIMPLE_AUDIT_RETENTION
+    policies = {}
+    for label, days in retention.items():
+        if label == DEFAULT:
+            policies[None] = days
+        else:
+            # audits of proxy models are stored with the content type of their concrete model
+            policies[ContentType.objects.get_for_model(apps.get_model(label))] = days
+    return policies
+
+
+def expired(using=None, now=None, retention=None):
+    """
+    Returns the audits whose retention period is over, or None when none can be.
+    """
+    now = now or timezone.now()
+    policies = get_policies(retention)
+    default = policies.pop(None, None)
+    condition = models.Q()
+    for content_type, days in policies.items():
+        if days is not None:
+            condition |= models.Q(content_type=content_type, date__lt=now - timedelta(days=days))
+    if default is not None:
+        condition |= models.Q(date__lt=now - timedelta(days=default)) & ~models.Q(content_type__in=list(policies))
+    if not condition:
+        return None
+    return Audit.objects.using(using).filter(condition)
+
+
+def write_archive(directory, audits):
+    """
+    Writes audits, with their changes and requests, to a gzipped file of journal lines named
+    after their id range, which journal.load_events can load back. The file is replaced
+    atomically, so archiving the same batch twice leaves a single copy.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "audits-%012d-%012d.jsonl.gz" % (audits[0].pk, audits[-1].pk))
+    with gzip.open(path + ".tmp", "wb") as archive:
+        for audit in audits:
+            archive.write(journal.serialize(audit, audit.field_changes.all()).encode("utf-8"))
+    os.rename(path + ".tmp", path)
+    return path
+
+
+def prune_batch(audits, using=None, archive_dir=None, archive_format=ARCHIVE_JSONL):
+    """
+    Deletes (after archiving them in archive_format if archive_dir) the audits of a queryset, with their
+    changes and the audit requests left without audits, in one transaction. Returns the
+    number of audits deleted.
+    """
+    with transaction.atomic(using=using):
+        batch = list(
+            audits.select_related("content_type", "audit_request")
+            .prefetch_related("field_changes").order_by("pk")
+        )
+        if not batch:
+            return 0
+        if archive_dir and archive_format == ARCHIVE_COLUMNAR:
+            archive.write_chunk(archive_dir, batch)
+        elif archive_dir:
+            write_archive(archive_dir, batch)
+
+        ids = [audit.pk for audit in batch]
+        request_ids = set(audit.audit_request_id for audit in batch if audit.audit_request_id is not None)
+        search.delete(ids, using)
+        Audit.objects.using(using).filter(pk__in=ids).delete()
+        if request_ids:
+            AuditRequest.objects.using(using).filter(pk__in=request_ids, audit__isnull=True).delete()
+    return len(batch)
@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+"""
+Reverting audits.
+
+revert undoes a set of audits, like every audit of an AuditRequest, newest
+first and in one transaction: a change gets its old values back, an addition is
+deleted and a deletion is inserted again. The changes of all the audits are
+read in one query and the audited objects in one query per model; every object
+is then written once, with the values of all its audits coerced through the
+to_python of their fields, and saved with update_fields. The objects are saved
+with their signals, so the revert itself is audited.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import collections
+import logging
+import re
+
+from django.db import router, transaction
+
+from .models import Audit
+
+LOG = logging.getLogger(__name__)
+
+
+class RevertError(Exception):
+    pass
+
+
+class RevertedObject(object):
+    """
+    The state an audited object is reverted to, built from its audits newest first.
+    """
+
+    def __init__(self, model, pk, instance):
+        self.model = model
+        self.pk = pk
+        self.instance = instance
+        self.existed = instance is not None
+        self.exists = instance is not None
+        self.update_fields = set()
+
+    def set_values(self, changes, old):
+        from .signal import from_text, get_plan
+
+        fields = dict((name, attname) for name, attname, converter in get_plan(self.model))
+        for change in changes:
+            if change.field not in fields or re.match(change.field, 'password'):
+                # m2m changes and masked passwords can not be reverted
+                continue
+            field = self.model._meta.get_field(change.field)
+            value = change.old_value if old else change.new_value
+            setattr(self.instance, fields[change.field], from_text(field, value))
+            self.update_fields.add(field.name)
+
+    def revert(self, audit):
+        if audit.operation == Audit.DELETE:
+            self.instance = self.model(pk=self.pk)
+            self.exists = True
+            self.set_values(audit.field_changes.all(), old=False)
+        elif audit.operation == Audit.ADD:
+            self.exists = False
+        elif not self.exists:
+            raise RevertError("%s %s does not exist, audit %d can not be reverted" % (
+                self.model.__name__, self.pk, audit.pk))
+        else:
+            self.set_values(audit.field_changes.all(), old=True)
+
+    def save(self, using):
+        """
+        Writes the reverted object, returns whether anything was written.
+        """
+        if self.existed and not self.exists:
+            self.instance.delete(using=using)
+        elif self.exists and not self.existed:
+            for field in self.model._meta.concrete_fields:
+                if field.name in getattr(self.model, 'EXCLUDE_FIELDS_FROM_AUDIT', ()) \
+                        and not field.null and not field.has_default():
+                    raise RevertError("%s %s can not be inserted again, its field %s is not audited" % (
+                        self.model.__name__, self.pk, field.name))
+            self.instance.save(force_insert=True, using=using)
+        elif self.exists and self.update_fields:
+            self.instance.save(update_fields=sorted(self.update_fields), using=using)
+        else:
+            return False
+        return True
+
+
+def revert(audits, using=None):
+    """
+    Reverts audits (a queryset or a list of audits), newest first, in one transaction, and
+    returns the number of objects written. Raises RevertError, having written nothing, if an
+    audited change can not be reverted because its object does not exist.
+    """
+    using = using or router.db_for_write(Audit)
+    with transaction.atomic(using=using):
+        if not hasattr(audits, "prefetch_related"):
+            audits = Audit.objects.using(using).filter(pk__in=[audit.pk for audit in audits])
+        audits = list(audits.select_related("content_type").prefetch_related("field_changes").order_by("-date", "-id"))
+
+        object_ids = collections.defaultdict(set)
+        for audit in audits:
+            object_ids[audit.content_type.model_class()].add(audit.object_id)
+        instances = {}
+        for model, pks in object_ids.items():
+            for pk, instance in model._default_manager.using(using).in_bulk(list(pks)).items():
+                instances[(model, pk)] = instance
+
+        # in the order they are met, so the newest deleted objects (the parents) are inserted first
+        objects = collections.OrderedDict()
+        for audit in audits:
+            model = audit.content_type.model_class()
+            key = (model, audit.object_id)
+            if key not in objects:
+                objects[key] = RevertedObject(model, audit.object_id, instances.get(key))
+            objects[key].revert(audit)
+
+        written = sum(1 for reverted in objects.values() if reverted.save(using))
+        LOG.debug("reverted %d audits of %d objects" % (len(audits), len(objects)))
+    return written
+
+
+def revert_request(audit_request, using=None):
+    """
+    Reverts every audit of an AuditRequest.
+    """
+    return revert(Audit.objects.using(using or router.db_for_write(Audit)).filter(audit_request=audit_request),
+                  using=using)
@@ -0,0 +1,163 @@
+# -*- coding:utf-8 -*-
+"""
+Full-text search of audits.
+
+When DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND is set, the text of every audit (its
+description, object description and the field names and values of its
+changes) is added to a full-text index when the audit is written, and
+AuditQuerySet.search and the admin search use that index instead of icontains
+over the audit table.
+
+The backends keep the index in a table of their own, keyed by audit id, which
+the rebuild_audit_search management command creates and fills from the audits
+already written. Rows are inserted or replaced, never dropped, so rebuilding
+while audits are written and indexed loses none of them.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import abc
+import logging
+import re
+
+from django.db import connections, transaction
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from . import settings
+
+LOG = logging.getLogger(__name__)
+
+TABLE = "audit_search"
+
+
+def document(audit, changes):
+    """
+    Returns the text of an audit which is indexed.
+    """
+    parts = [audit.description, audit.obj_description]
+    for change in changes:
+        parts.extend((change.field, change.old_value, change.new_value))
+    return "\n".join(part for part in parts if part)
+
+
+class SearchBackend(abc.ABC):
+
+    @abc.abstractmethod
+    def create(self, using):
+        """
+        Creates the index, unless it exists.
+        """
+
+    def index(self, entries, using):
+        """
+        Adds the text of the written (audit, changes) entries to the index.
+        """
+        rows = [(audit.pk, document(audit, changes)) for audit, changes in entries]
+        with connections[using].cursor() as cursor:
+            cursor.executemany(self.insert_sql, rows)
+
+    def delete(self, ids, using):
+        """
+        Removes the audits of ids from the index.
+        """
+        with connections[using].cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                TABLE, self.id_column, ", ".join(["%s"] * len(ids))), list(ids))
+
+    @abc.abstractmethod
+    def matching_ids(self, query):
+        """
+        Returns an expression selecting the ids of the audits matching query.
+        """
+
+    def filter(self, queryset, query):
+        return queryset.filter(pk__in=self.matching_ids(query))
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    An FTS5 virtual table, whose rowid is the audit id.
+    """
+    id_column = "rowid"
+    insert_sql = "INSERT OR REPLACE INTO %s (rowid, document) VALUES (%%s, %%s)" % TABLE
+
+    def create(self, using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(document)" % TABLE)
+
+    def matching_ids(self, query):
+        # every word of the query as a prefix, so FTS5 operators in it are taken literally
+        words = re.findall(r"\w+", query)
+        match = " ".join('"%s"*' % word for word in words) or '""'
+        return RawSQL("SELECT rowid FROM %s WHERE %s MATCH %%s" % (TABLE, TABLE), [match])
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    A table of tsvector documents with a GIN index, in the DJANGO_SIMPLE_AUDIT_SEARCH_CONFIG
+    text search configuration.
+    """
+    id_column = "audit_id"
+
+    @property
+    def insert_sql(self):
+        return (
+            "INSERT INTO %s (audit_id, document) VALUES (%%s, to_tsvector('%s', %%s)) "
+            "ON CONFLICT (audit_id) DO UPDATE SET document = EXCLUDED.document"
+        ) % (TABLE, settings.DJANGO_SIMPLE_AUDIT_SEARCH_CONFIG)
+
+    def create(self, using):
+        with connections[using].cursor() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS %s (audit_id integer PRIMARY KEY, document tsvector NOT NULL)" % TABLE)
+            cursor.execute("CREATE INDEX IF NOT EXISTS %s_document_idx ON %s USING gin (document)" % (TABLE, TABLE))
+
+    def matching_ids(self, query):
+        return RawSQL(
+            "SELECT audit_id FROM %s WHERE document @@ plainto_tsquery('%s', %%s)" % (
+                TABLE, settings.DJANGO_SIMPLE_AUDIT_SEARCH_CONFIG),
+            [query]
+        )
+
+
+_backends = {}
+
+
+def get_backend():
+    """
+    Returns the configured search backend, or None.
+    """
+    path = settings.DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND
+    if not path:
+        return None
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def index(entries, using):
+    """
+    Adds written audits to the search index, if there is one. An audit is never lost
+    because indexing it failed.
+    """
+    backend = get_backend()
+    if backend is None or not entries:
+        return
+    try:
+        with transaction.atomic(using=using):
+            backend.index(entries, using)
+    except:
+        LOG.error(u'Error indexing %d audits for search', len(entries), exc_info=True)
+
+
+def delete(ids, using):
+    """
+    Removes deleted audits from the search index, if there is one.
+    """
+    backend = get_backend()
+    if backend is None or not ids:
+        return
+    try:
+        with transaction.atomic(using=using):
+            backend.delete(ids, using)
+    except:
+        LOG.error(u'Error removing %d audits from the search index', len(ids), exc_info=True)
@@ -8,6 +8,109 @@ LOG = logging.getLogger(__name__)
 DJANGO_SIMPLE_AUDIT_ACTIVATED = getattr(settings, 'DJANGO_SIMPLE_AUDIT_ACTIVATED', False)
 DJANGO_SIMPLE_AUDIT_M2M_FIELDS = getattr(settings, 'DJANGO_SIMPLE_AUDIT_M2M_FIELDS', False)
 
+"""
+  DJANGO_SIMPLE_AUDIT_BUFFERED_WRITES keeps audits registered inside a transaction in memory
+  and writes them with bulk_create when the transaction commits. They are discarded if the
+  transaction is rolled back.
+"""
+DJANGO_SIMPLE_AUDIT_BUFFERED_WRITES = getattr(settings, 'DJANGO_SIMPLE_AUDIT_BUFFERED_WRITES', False)
+
+"""
+  The middleware tracks (creates an AuditRequest for) every request whose method is not in
+  DJANGO_SIMPLE_AUDIT_SKIP_METHODS, unless its path matches one of the regular expressions of
+  DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS. Paths matching DJANGO_SIMPLE_AUDIT_INCLUDE_PATHS are tracked
+  whatever their method. DJANGO_SIMPLE_AUDIT_SAMPLING maps path regular expressions to the
+  fraction of their requests which are tracked, e.g. {r'^/telemetry/': 0.01}.
+"""
+DJANGO_SIMPLE_AUDIT_SKIP_METHODS = getattr(settings, 'DJANGO_SIMPLE_AUDIT_SKIP_METHODS', ('GET',))
+DJANGO_SIMPLE_AUDIT_INCLUDE_PATHS = getattr(settings, 'DJANGO_SIMPLE_AUDIT_INCLUDE_PATHS', ())
+DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS = getattr(settings, 'DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS', ())
+DJANGO_SIMPLE_AUDIT_SAMPLING = getattr(settings, 'DJANGO_SIMPLE_AUDIT_SAMPLING', {})
+
+"""
+  DJANGO_SIMPLE_AUDIT_REQUEST_BUFFER makes the middleware keep the audits of a request in memory
+  and write them, with their AuditRequest, in one transaction when the response is returned.
+  They are discarded if the view raised an exception.
+"""
+DJANGO_SIMPLE_AUDIT_REQUEST_BUFFER = getattr(settings, 'DJANGO_SIMPLE_AUDIT_REQUEST_BUFFER', False)
+
+"""
+  DJANGO_SIMPLE_AUDIT_WRITER_THREAD hands audits to a background thread that writes them in
+  batches, instead of writing them in the thread that saved the model. The queue holds at most
+  DJANGO_SIMPLE_AUDIT_WRITER_QUEUE_SIZE audits; when it is full, saving waits for the writer,
+  or the audit is dropped if DJANGO_SIMPLE_AUDIT_WRITER_BLOCK is False.
+"""
+DJANGO_SIMPLE_AUDIT_WRITER_THREAD = getattr(settings, 'DJANGO_SIMPLE_AUDIT_WRITER_THREAD', False)
+DJANGO_SIMPLE_AUDIT_WRITER_BATCH_SIZE = getattr(settings, 'DJANGO_SIMPLE_AUDIT_WRITER_BATCH_SIZE', 500)
+DJANGO_SIMPLE_AUDIT_WRITER_FLUSH_INTERVAL = getattr(settings, 'DJANGO_SIMPLE_AUDIT_WRITER_FLUSH_INTERVAL', 1.0)
+DJANGO_SIMPLE_AUDIT_WRITER_QUEUE_SIZE = getattr(settings, 'DJANGO_SIMPLE_AUDIT_WRITER_QUEUE_SIZE', 10000)
+DJANGO_SIMPLE_AUDIT_WRITER_BLOCK = getattr(settings, 'DJANGO_SIMPLE_AUDIT_WRITER_BLOCK', True)
+DJANGO_SIMPLE_AUDIT_WRITER_SHUTDOWN_TIMEOUT = getattr(settings, 'DJANGO_SIMPLE_AUDIT_WRITER_SHUTDOWN_TIMEOUT', 10)
+
+"""
+  DJANGO_SIMPLE_AUDIT_JOURNAL_DIR appends audits to segment files in that directory instead of
+  writing them to the database. Use the ingest_audit_journal command to load them. With
+  DJANGO_SIMPLE_AUDIT_JOURNAL_FALLBACK audits are only appended when writing them to the database
+  fails. DJANGO_SIMPLE_AUDIT_JOURNAL_FSYNC is 'always' (every write), 'segment' (when a segment is
+  closed) or 'never'.
+"""
+DJANGO_SIMPLE_AUDIT_JOURNAL_DIR = getattr(settings, 'DJANGO_SIMPLE_AUDIT_JOURNAL_DIR', None)
+DJANGO_SIMPLE_AUDIT_JOURNAL_FALLBACK = getattr(settings, 'DJANGO_SIMPLE_AUDIT_JOURNAL_FALLBACK', False)
+DJANGO_SIMPLE_AUDIT_JOURNAL_FSYNC = getattr(settings, 'DJANGO_SIMPLE_AUDIT_JOURNAL_FSYNC', 'segment')
+DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_SIZE = getattr(settings, 'DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_SIZE', 16 * 1024 * 1024)
+DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_AGE = getattr(settings, 'DJANGO_SIMPLE_AUDIT_JOURNAL_SEGMENT_AGE', 60)
+
+"""
+  DJANGO_SIMPLE_AUDIT_SNAPSHOTS keeps the audited values of registered models when they are
+  loaded from the database, so saving a change does not need to select the old state again.
+"""
+DJANGO_SIMPLE_AUDIT_SNAPSHOTS = getattr(settings, 'DJANGO_SIMPLE_AUDIT_SNAPSHOTS', False)
+
+"""
+  DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES stores only the field changes of an audited change and
+  leaves its description empty. Audit.get_description renders it when it is read, in the
+  active language.
+"""
+DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES = getattr(settings, 'DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES', False)
+
+"""
+  DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL writes the full state of an object after about every that
+  many audits of it, so reconstructing it at a point in time (Audit.objects.as_of) replays a bounded
+  number of changes. 0 writes no checkpoints, the whole history of the object is replayed.
+"""
+DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL = getattr(settings, 'DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL', 0)
+
+"""
+  DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND is the dotted path of the full-text search backend which
+  indexes audits when they are written, 'simple_audit.search.SQLiteSearchBackend' (FTS5) or
+  'simple_audit.search.PostgresSearchBackend' (tsvector, in the DJANGO_SIMPLE_AUDIT_SEARCH_CONFIG
+  text search configuration). Create its index with the rebuild_audit_search command.
+"""
+DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND = getattr(settings, 'DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND', None)
+DJANGO_SIMPLE_AUDIT_SEARCH_CONFIG = getattr(settings, 'DJANGO_SIMPLE_AUDIT_SEARCH_CONFIG', 'simple')
+
+"""
+  DJANGO_SIMPLE_AUDIT_RETENTION maps audited models ('app_label.model_name', or '*' for the others)
+  to the number of days their audits are kept by the prune_audits command (None keeps them).
+  For example {'*': 365, 'auth.user': None}. Nothing is pruned by default.
+"""
+DJANGO_SIMPLE_AUDIT_RETENTION = getattr(settings, 'DJANGO_SIMPLE_AUDIT_RETENTION', {})
+
+"""
+  DJANGO_SIMPLE_AUDIT_FEED_CACHE is the alias of the cache (in CACHES) where the latest
+  DJANGO_SIMPLE_AUDIT_FEED_SIZE audits, and those of every user, are kept for the get_audit_log
+  template tag, for DJANGO_SIMPLE_AUDIT_FEED_TIMEOUT seconds. None reads them from the database.
+"""
+DJANGO_SIMPLE_AUDIT_FEED_CACHE = getattr(settings, 'DJANGO_SIMPLE_AUDIT_FEED_CACHE', None)
+DJANGO_SIMPLE_AUDIT_FEED_SIZE = getattr(settings, 'DJANGO_SIMPLE_AUDIT_FEED_SIZE', 50)
+DJANGO_SIMPLE_AUDIT_FEED_TIMEOUT = getattr(settings, 'DJANGO_SIMPLE_AUDIT_FEED_TIMEOUT', 24 * 3600)
+
+"""
+  DJANGO_SIMPLE_AUDIT_ADMIN_COUNT_LIMIT is the most audits the admin changelist counts, it shows
+  "10000+" beyond that.
+"""
+DJANGO_SIMPLE_AUDIT_ADMIN_COUNT_LIMIT = getattr(settings, 'DJANGO_SIMPLE_AUDIT_ADMIN_COUNT_LIMIT', 10000)
+
 """
   DJANGO_SIMPLE_AUDIT_REST_FRAMEWORK_AUTHENTICATOR setting should be set to 
   Django REST Framework authentication class if framework is being used
@@ -16,7 +119,3 @@ DJANGO_SIMPLE_AUDIT_M2M_FIELDS = getattr(settings, 'DJANGO_SIMPLE_AUDIT_M2M_FIEL
   DJANGO_SIMPLE_AUDIT_REST_FRAMEWORK_AUTHENTICATOR = 'rest_framework.authentication.TokenAuthentication'
 """
 DJANGO_SIMPLE_AUDIT_REST_FRAMEWORK_AUTHENTICATOR = getattr(settings, 'DJANGO_SIMPLE_AUDIT_AUTHENTICATOR', None)
-
-if not hasattr(settings, 'CACHES'):
-    LOG.warning("no cache backend set in django! m2m auditing will be disabled")
-    DJANGO_SIMPLE_AUDIT_M2M_FIELDS = False
@@ -1,79 +1,132 @@
 # -*- coding:utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 
+import contextvars
+import json
 import logging
 import re
-import threading
-from pprint import pprint
+from contextlib import contextmanager
 
 import six
+from asgiref.sync import sync_to_async
 from django import VERSION as DJANGO_VERSION
-from django.core.cache import cache
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
-from . import m2m_audit, settings
-from .models import Audit, AuditChange
+from . import checkpoints, m2m_audit, settings, state, writer
+from .models import Audit, AuditChange, describe_changes
 
 MODEL_LIST = set()
+MODEL_PLANS = {}
 LOG = logging.getLogger(__name__)
-DEFAULT_CACHE_TIMEOUT = 120
-
-
-def get_cache_key_for_instance(instance, cache_prefix="django_simple_audit"):
-    return "%s:%s:%s" % (cache_prefix, instance.__class__.__name__, instance.pk)
+SKIP_DELETE = contextvars.ContextVar("simple_audit_skip_delete", default=None)
 
 
 def audit_m2m_change(sender, **kwargs):
     """
     audit m2m changes if the settings DJANGO_SIMPLE_AUDIT_M2M_FIELDS is set to True
     """
-    if kwargs.get('action'):
-        instance = kwargs.get('instance')
-        if kwargs['action'] == "pre_add":
-            pass
-        elif kwargs['action'] == "post_add":
-            cache_key = get_cache_key_for_instance(instance)
-            dict_ = cache.get(cache_key)
-            if not dict_:
-                dict_ = {"old_state": {}, "new_state": {}}
-
-            dict_["new_state"] = m2m_audit.get_m2m_values_for(instance=instance)
-            dict_["m2m_change"] = True
-            cache.set(cache_key, dict_, DEFAULT_CACHE_TIMEOUT)
-            save_audit(instance, Audit.CHANGE, kwargs=dict_)
-        elif kwargs['action'] == "pre_remove":
-            pass
-        elif kwargs['action'] == "post_remove":
-            save_audit(kwargs['instance'], Audit.DELETE, kwargs=kwargs)
-        elif kwargs['action'] == "pre_clear":
-            pass
-        elif kwargs['action'] == "post_clear":
-            pass
+    action = kwargs.get('action')
+    instance = kwargs['instance']
+    reverse = kwargs['reverse']
+    using = kwargs['using']
+    # the model which declares the m2m field, instance is on the other side if reverse
+    model = kwargs['model'] if reverse else instance.__class__
+    if model not in MODEL_LIST:
+        return
+    m2m_field = m2m_audit.get_m2m_field_for_through(model, sender)
+    if m2m_field is None:
+        return
+    state_key = m2m_audit.get_state_key(sender, instance)
+
+    if action == "post_add":
+        # pk_set holds only the primary keys which were really added
+        rows = set((pk, instance.pk) if reverse else (instance.pk, pk) for pk in kwargs['pk_set'] or ())
+        audit_m2m_rows(model, m2m_field, rows, using, added=True, instance=None if reverse else instance)
+    elif action in ("pre_remove", "pre_clear"):
+        # pk_set of a remove may hold unrelated pks, keep what is really going to be removed
+        rows = m2m_audit.get_through_rows(m2m_field, instance, reverse, pks=kwargs['pk_set'], using=using)
+        state.put(using, state_key, rows)
+    elif action in ("post_remove", "post_clear"):
+        rows = state.get(using, state_key)
+        state.discard(using, state_key)
+        if rows:
+            audit_m2m_rows(model, m2m_field, rows, using, added=False, instance=None if reverse else instance)
+
+
+def audit_m2m_rows(model, m2m_field, rows, using, added, instance=None):
+    """
+    audits the (source pk, target pk) rows added to or removed from the through table
+    of m2m_field, one audit per instance of model. instance is the only source, if given.
+    """
+    related = {}
+    for source_pk, target_pk in rows:
+        related.setdefault(source_pk, set()).add(target_pk)
+    if instance is not None:
+        objs = {instance.pk: instance}
+    else:
+        objs = model._base_manager.using(using).in_bulk(list(related))
+
+    for pk, pks in related.items():
+        obj = objs.get(pk)
+        if obj is None:
+            continue
+        values = {m2m_field.name: pks}
+        save_audit(obj, Audit.CHANGE, kwargs={
+            "m2m_change": True,
+            "old_state": {} if added else values,
+            "new_state": values if added else {},
+        })
+
+
+def audit_post_init(sender, **kwargs):
+    """
+    keeps the audited values of the instance as loaded, if the setting
+    DJANGO_SIMPLE_AUDIT_SNAPSHOTS is set to True, so a later change can be
+    diffed without reading the old state from the database
+    """
+    if settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS:
+        instance = kwargs['instance']
+        instance.__dict__[SNAPSHOT_ATTR] = take_snapshot(instance)
 
 
 def audit_post_save(sender, **kwargs):
     if kwargs['created'] and not kwargs.get('raw', False):
         save_audit(kwargs['instance'], Audit.ADD)
+    if settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS:
+        # what was saved is the state the next change will be compared to
+        instance = kwargs['instance']
+        instance.__dict__[SNAPSHOT_ATTR] = take_snapshot(instance)
 
 
 def audit_pre_save(sender, **kwargs):
     instance = kwargs.get('instance')
     if instance._state.adding is not True and not kwargs.get('raw', False):
-        if settings.DJANGO_SIMPLE_AUDIT_M2M_FIELDS:
-            if m2m_audit.get_m2m_fields_for(instance): #has m2m fields?
-                cache_key = get_cache_key_for_instance(instance)
-                dict_ = {"old_state" : {}, "new_state": {}}
-                dict_["old_state"] = m2m_audit.get_m2m_values_for(instance=instance)
-                cache.set(cache_key, dict_, DEFAULT_CACHE_TIMEOUT)
-                LOG.debug("old_state saved in cache with key %s for m2m auditing" % cache_key)
         save_audit(kwargs['instance'], Audit.CHANGE)
 
 
 def audit_pre_delete(sender, **kwargs):
+    skipped = SKIP_DELETE.get()
+    if skipped and (sender, kwargs['instance'].pk) in skipped:
+        return
     save_audit(kwargs['instance'], Audit.DELETE)
 
 
+@contextmanager
+def skip_delete_audits(model, pks):
+    """
+    Deleting instances of model with these pks inside this block is not audited by the
+    pre_delete signal, because the caller already audited it.
+    """
+    token = SKIP_DELETE.set((SKIP_DELETE.get() or set()) | set((model, pk) for pk in pks))
+    try:
+        yield
+    finally:
+        SKIP_DELETE.reset(token)
+
+
 def register(*my_models):
     if not settings.DJANGO_SIMPLE_AUDIT_ACTIVATED:
         return False
@@ -82,10 +135,14 @@ def register(*my_models):
         if model is not None:
             if model not in MODEL_LIST:
                 MODEL_LIST.add(model)
+            MODEL_PLANS[model] = compile_plan(model)
             models.signals.pre_save.connect(audit_pre_save, sender=model)
             models.signals.post_save.connect(audit_post_save, sender=model)
             models.signals.pre_delete.connect(audit_pre_delete, sender=model)
 
+            if settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS:
+                models.signals.post_init.connect(audit_post_init, sender=model)
+
             # signals for m2m fields
             if settings.DJANGO_SIMPLE_AUDIT_M2M_FIELDS:
                 # model._meta.get_m2m_with_model is removed in 1.9
@@ -108,27 +165,51 @@ def register(*my_models):
 
 
 NOT_ASSIGNED = object()
+SNAPSHOT_ATTR = '_audit_snapshot'
 
 
-def get_value(obj, attr):
+def get_converter(field):
     """
-    Returns the value of an attribute. First it tries to return the unicode value.
+    Returns the function used to store a value of field as text.
     """
-    if hasattr(obj, attr):
-        value = getattr(obj, attr)
-        if value is None:
-            return None
-        if isinstance(value, models.Model):
-            value = value.pk
-        try:
-            return six.text_type(value)
-        except:
-            if hasattr(value, 'all'):
-                return [six.text_type(v) for v in value.all()]
-            else:
-                return value
-    else:
+    if isinstance(field, models.JSONField):
+        # keys are sorted so a reordering by the database is not seen as a change
+        return lambda value: json.dumps(value, sort_keys=True, cls=DjangoJSONEncoder)
+    return six.text_type
+
+
+def from_text(field, value):
+    """
+    Returns the Python value of field stored as text by the converter of get_converter.
+    """
+    if value is None:
         return None
+    if isinstance(field, models.JSONField):
+        return json.loads(value)
+    if field.is_relation:
+        field = field.target_field
+    return field.to_python(value)
+
+
+def compile_plan(model):
+    """
+    Returns the snapshot plan of model: a tuple of (name, attname, converter) for each audited
+    concrete field. Foreign keys are read from their attname (the *_id column), so a snapshot
+    never loads related objects.
+    """
+    exclude = frozenset(getattr(model, 'EXCLUDE_FIELDS_FROM_AUDIT', ()))
+    return tuple(
+        (field.name, field.attname, get_converter(field))
+        for field in model._meta.concrete_fields
+        if field.name not in exclude
+    )
+
+
+def get_plan(model):
+    plan = MODEL_PLANS.get(model)
+    if plan is None:
+        plan = MODEL_PLANS[model] = compile_plan(model)
+    return plan
 
 
 def to_dict(obj):
@@ -136,18 +217,29 @@ def to_dict(obj):
         return {}
 
     if isinstance(obj, dict):
-        return dict.copy()
+        return dict(obj)
 
     state = {}
+    values = obj.__dict__
+    for name, attname, converter in get_plan(obj.__class__):
+        value = values[attname] if attname in values else getattr(obj, attname)
+        state[name] = None if value is None else converter(value)
 
-    field_names = [
-        f.name for f in obj._meta.get_fields()
-        if f.name not in getattr(obj.__class__, 'EXCLUDE_FIELDS_FROM_AUDIT', [])
-    ]
+    return state
 
-    for key in field_names:
-        state[key] = get_value(obj, key)
 
+def take_snapshot(obj):
+    """
+    Returns the audited fields of obj as they are now, in the same format as to_dict.
+    Returns None if some field is deferred, because reading it would need a query.
+    """
+    values = obj.__dict__
+    state = {}
+    for name, attname, converter in get_plan(obj.__class__):
+        if attname not in values:
+            return None
+        value = values[attname]
+        state[name] = None if value is None else converter(value)
     return state
 
 
@@ -172,111 +264,144 @@ def dict_diff(old, new):
     return diff
 
 
-def format_value(v):
-    if isinstance(v, six.string_types):
-        return "'{}'".format(v)
-    return six.text_type(v)
+def describe(instance, operation, changed_fields=None):
+    """
+    Returns the description of an audit of instance.
+    """
+    if operation == Audit.DELETE:
+        return _('Deleted %s') % six.text_type(instance)
+    elif operation == Audit.ADD:
+        return _('Added %s') % six.text_type(instance)
+    elif settings.DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES:
+        # rendered from the field changes when read, see Audit.get_description
+        return ""
+    return describe_changes(changed_fields)
 
 
 def save_audit(instance, operation, kwargs=None):
     """
     Saves the audit.
-    However, the variable persist_audit controls if the audit should be really
-    saved to the database or not. This variable is only affected in a change operation. If no
-    change is detected than it is setted to False.
+    However, the audit is only saved to the database if audit_entry returns one. This is
+    only affected in a change operation. If no change is detected nothing is saved.
 
     Keyword arguments:
     instance -- instance
     operation -- operation type (add, change, delete)
     kwargs -- kwargs dict sent from m2m signal
     """
-    kwargs = kwargs or {}
+    try:
+        entry = audit_entry(instance, operation, kwargs)
+        if entry is not None:
+            writer.persist(*entry)
+    except:
+        LOG.error(u'Error registering auditing to %s: (%s) %s',
+            repr(instance), type(instance), getattr(instance, '__dict__', None), exc_info=True)
 
-    m2m_change = kwargs.get('m2m_change', False)
 
+async def asave_audit(instance, operation, kwargs=None):
+    """
+    Saves the audit from async code. The old state of a change is read with the async ORM and
+    the audit is written in a single thread hop, or kept in memory inside writer.abuffered and
+    the async middleware.
+    """
     try:
-        persist_audit = True
+        if instance.get_deferred_fields():
+            # reading the deferred fields would query the database from the event loop
+            await sync_to_async(save_audit)(instance, operation, kwargs)
+            return
+
+        old_obj = NOT_ASSIGNED
+        m2m_change = (kwargs or {}).get('m2m_change', False)
+        if operation == Audit.CHANGE and instance.pk and not m2m_change \
+                and (getattr(instance, SNAPSHOT_ATTR, None) is None or take_snapshot(instance) is None):
+            old_obj = await instance.__class__.objects.filter(pk=instance.pk).afirst()
+        try:
+            ContentType.objects._get_from_cache(instance._meta.concrete_model._meta)
+        except KeyError:
+            await sync_to_async(ContentType.objects.get_for_model)(instance)
+
+        entry = audit_entry(instance, operation, kwargs, old_obj=old_obj)
+        if entry is not None:
+            await writer.awrite([entry])
+    except:
+        LOG.error(u'Error registering auditing to %s: (%s) %s',
+            repr(instance), type(instance), getattr(instance, '__dict__', None), exc_info=True)
+
+
+def audit_entry(instance, operation, kwargs=None, old_obj=NOT_ASSIGNED):
+    """
+    Returns the unsaved audit of instance and its unsaved changes, or None when a change
+    changed nothing. old_obj is the stored instance a change is compared to; it is read
+    from the database when not given and there is no snapshot.
+    """
+    kwargs = kwargs or {}
+
+    m2m_change = kwargs.get('m2m_change', False)
 
+    snapshot = None
+    new_state = None
+    if operation == Audit.CHANGE and not m2m_change:
+        snapshot = getattr(instance, SNAPSHOT_ATTR, None)
+        if snapshot is not None:
+            new_state = take_snapshot(instance)
+    if new_state is None and not m2m_change:
+        snapshot = None
         new_state = to_dict(instance)
-        old_state = {}
-        try:
-            if operation == Audit.CHANGE and instance.pk:
-                if not m2m_change:
-                    old_state = to_dict(instance.__class__.objects.get(pk=instance.pk))
+    old_state = {}
+    try:
+        if operation == Audit.CHANGE and instance.pk:
+            if not m2m_change:
+                if snapshot is not None:
+                    old_state = snapshot
                 else:
-                    #m2m change
-                    LOG.debug("m2m change detected")
-                    new_state = kwargs.get("new_state", {})
-                    old_state = kwargs.get("old_state", {})
-        except:
-            pass
-
-        if m2m_change:
-            #m2m_change returns a list of changes
-            changed_fields = m2m_audit.m2m_dict_diff(old_state, new_state)
-        else:
-            changed_fields = dict_diff(old_state, new_state)
-
-        if operation == Audit.CHANGE:
-            #is there any change?
-            if not changed_fields:
-                persist_audit = False
-
-            if m2m_change:
-                descriptions = []
-                for changed_field in changed_fields:
-                    description = u"\n".join([u"%s %s: %s %s %s %s" %
-                        (
-                            _("field"),
-                            k,
-                            _("was changed from"),
-                            format_value(v[0]),
-                            _("to"),
-                            format_value(v[1]),
-                        ) for k, v in changed_field.items()])
-                    descriptions.append(description)
+                    if old_obj is NOT_ASSIGNED:
+                        old_obj = instance.__class__.objects.get(pk=instance.pk)
+                    if old_obj is not None:
+                        old_state = to_dict(old_obj)
             else:
-                description = u"\n".join([u"%s %s: %s %s %s %s" %
-                    (
-                        _("field"),
-                        k,
-                        _("was changed from"),
-                        format_value(v[0]),
-                        _("to"),
-                        format_value(v[1]),
-                    ) for k, v in changed_fields.items()])
-        elif operation == Audit.DELETE:
-            description = _('Deleted %s') % six.text_type(instance)
-        elif operation == Audit.ADD:
-            description = _('Added %s') % six.text_type(instance)
-
-        LOG.debug("called audit with operation=%s instance=%s persist=%s" % (operation, instance, persist_audit))
-        if persist_audit:
-            if m2m_change:
-                for description in descriptions:
-                    audit = Audit.register(instance, description, operation)
-                    changed_field = changed_fields.pop(0)
-
-                    for field, (old_value, new_value) in changed_field.items():
-                        change = AuditChange()
-                        change.audit = audit
-                        change.field = field
-                        change.new_value = new_value
-                        change.old_value = old_value
-                        change.save()
-            else:
-                audit = Audit.register(instance, description, operation)
-
-                for field, (old_value, new_value) in changed_fields.items():
-                    change = AuditChange()
-                    change.audit = audit
-                    change.field = field
-                    change.new_value = new_value
-                    change.old_value = old_value
-                    change.save()
+                #m2m change
+                LOG.debug("m2m change detected")
+                new_state = kwargs.get("new_state", {})
+                old_state = kwargs.get("old_state", {})
     except:
-        LOG.error(u'Error registering auditing to %s: (%s) %s',
-            repr(instance), type(instance), getattr(instance, '__dict__', None), exc_info=True)
+        pass
+
+    if m2m_change:
+        changed_fields = m2m_audit.m2m_set_diff(old_state, new_state)
+    else:
+        changed_fields = dict_diff(old_state, new_state)
+
+    persist_audit = True
+    if operation == Audit.CHANGE:
+        #is there any change?
+        if not changed_fields:
+            persist_audit = False
+
+        description = describe(instance, operation, changed_fields)
+    else:
+        description = describe(instance, operation)
+
+    LOG.debug("called audit with operation=%s instance=%s persist=%s" % (operation, instance, persist_audit))
+    if persist_audit:
+        return build_audit(instance, description, operation, changed_fields)
+    return None
+
+
+def build_audit(instance, description, operation, changed_fields):
+    """
+    Returns an unsaved audit of instance and its unsaved AuditChange, one per changed field.
+    """
+    audit = Audit.register(instance, description, operation, commit=False)
+    changes = []
+    for field, (old_value, new_value) in changed_fields.items():
+        change = AuditChange()
+        change.field = field
+        change.new_value = new_value
+        change.old_value = old_value
+        changes.append(change)
+    if operation != Audit.DELETE and settings.DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL:
+        checkpoints.keep_state(audit, to_dict(instance))
+    return audit, changes
 
 
 def handle_unicode(s):
@@ -0,0 +1,93 @@
+# -*- coding:utf-8 -*-
+"""
+In-process state kept for the duration of a transaction.
+
+Auditing some changes needs a value captured before them, like the m2m
+relations of an instance before they are changed. Those values are kept in
+memory, in the context of the current thread (or task), for the duration of
+the transaction that changes them: they are forgotten when it commits, and the
+values set inside a savepoint are forgotten when that savepoint is rolled back.
+Outside a transaction nothing is kept.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import contextvars
+
+from django.db import transaction
+
+_scopes = contextvars.ContextVar("simple_audit_state", default=None)
+
+
+class TransactionState(dict):
+    """
+    Values set under the same savepoint of a transaction. The instance itself is registered
+    as on_commit callback, so Django discards it when that savepoint or the whole
+    transaction is rolled back.
+    """
+
+    def __init__(self, using):
+        super(TransactionState, self).__init__()
+        self.using = using
+        self.committed = False
+
+    def is_alive(self):
+        if self.committed:
+            return False
+        connection = transaction.get_connection(self.using)
+        return any(func is self for sids, func, robust in connection.run_on_commit)
+
+    def __call__(self):
+        self.committed = True
+        self.clear()
+
+
+def _get_scopes():
+    scopes = _scopes.get()
+    if scopes is None:
+        scopes = {}
+        _scopes.set(scopes)
+    return scopes
+
+
+def _alive_states(using):
+    scopes = _get_scopes()
+    for key in [k for k, state in scopes.items() if not state.is_alive()]:
+        del scopes[key]
+    return [state for (state_using, sids), state in scopes.items() if state_using == using]
+
+
+def get(using, key, default=None):
+    """
+    Returns the value set for key in the current transaction of the using database.
+    """
+    if not transaction.get_connection(using).in_atomic_block:
+        return default
+    for state in _alive_states(using):
+        if key in state:
+            return state[key]
+    return default
+
+
+def put(using, key, value):
+    """
+    Keeps value for key until the current transaction of the using database ends. Does
+    nothing outside a transaction.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return
+    # a key lives in a single state, the one of the savepoint that set it last
+    for state in _alive_states(using):
+        state.pop(key, None)
+    scopes = _get_scopes()
+    scope_key = (using, tuple(connection.savepoint_ids))
+    state = scopes.get(scope_key)
+    if state is None:
+        state = scopes[scope_key] = TransactionState(using)
+        transaction.on_commit(state, using=using)
+    state[key] = value
+
+
+def discard(using, key):
+    for state in _alive_states(using):
+        state.pop(key, None)
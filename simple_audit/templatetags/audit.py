@@ -1,7 +1,7 @@
 from django import template
 from django.contrib.contenttypes.models import ContentType
 
-from simple_audit.models import Audit
+from simple_audit import feed
 
 register = template.Library()
 
@@ -14,13 +14,14 @@ class AdminAuditNode(template.Node):
         return "<GetAuditLog Node>"
 
     def render(self, context):
-        if self.user is None:
-            context[self.varname] = Audit.objects.order_by('-date').all()[:self.limit]
-        else:
-            user_id = self.user
-            if not user_id.isdigit():
-                user_id = context[self.user].id
-            context[self.varname] = Audit.objects.filter(audit_request__user_id=user_id).order_by('-date')[:int(self.limit)]
+        user_id = self.user
+        if user_id is not None and not user_id.isdigit():
+            user_id = context[self.user].id
+        # from the cached feed when there is one
+        audits = feed.recent(int(self.limit), user_id)
+        if audits is None:
+            audits = feed.query(user_id)[:int(self.limit)]
+        context[self.varname] = audits
         return ''
 
 
@@ -48,6 +49,15 @@ def get_audit_log(parser, token):
     return AdminAuditNode(limit=tokens[1], varname=tokens[3], user=(len(tokens) > 5 and tokens[5] or None))
 
 
+@register.filter
+def audit_description(audit):
+    """
+    Usage:  {{ audit|audit_description }}, the description of audits stored without one
+            (see DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES) is rendered from their field changes
+    """
+    return audit.get_description()
+
+
 @register.filter
 def short_description(value, size):
     return ' '.join(value.split()[:size])
@@ -0,0 +1,131 @@
+# -*- coding:utf-8 -*-
+"""
+Background writer for audits.
+
+When DJANGO_SIMPLE_AUDIT_WRITER_THREAD is set, the thread that saves a model only
+computes its audit and puts it in a bounded queue. A writer thread, with its own
+database connection, takes the audits from the queue and writes them with
+bulk_create in batches of DJANGO_SIMPLE_AUDIT_WRITER_BATCH_SIZE, at most
+DJANGO_SIMPLE_AUDIT_WRITER_FLUSH_INTERVAL seconds after they were queued.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
+from . import settings
+
+LOG = logging.getLogger(__name__)
+
+STOP = object()
+
+
+class AuditWriterThread(threading.Thread):
+
+    def __init__(self, batch_size, flush_interval, queue_size, block):
+        super(AuditWriterThread, self).__init__(name="simple-audit-writer")
+        self.daemon = True
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pid = os.getpid()
+        self.dropped = 0
+
+    def submit(self, entries):
+        """
+        Queues (audit, changes) entries. When the queue is full it waits for the writer,
+        or drops the audit if DJANGO_SIMPLE_AUDIT_WRITER_BLOCK is False.
+        """
+        for entry in entries:
+            try:
+                self.queue.put(entry, block=self.block)
+            except queue.Full:
+                self.dropped += 1
+                LOG.warning(u"audit queue is full, dropping audit of %s %s (%d dropped so far)",
+                            entry[0].content_type, entry[0].object_id, self.dropped)
+
+    def stop(self, timeout=None):
+        """
+        Writes every queued audit and stops the thread.
+        """
+        self.queue.put(STOP)
+        self.join(timeout)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            # wait for the first audit, then for the rest of the batch until the interval ends
+            item = self.queue.get()
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while item is not STOP:
+                batch.append(item)
+                timeout = deadline - time.time()
+                if len(batch) >= self.batch_size or timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            stopping = item is STOP
+            self.write(batch)
+
+    def write(self, batch):
+        from .writer import bulk_write_or_spill
+
+        if not batch:
+            return
+        close_old_connections()
+        try:
+            bulk_write_or_spill(batch)
+        except:
+            LOG.error(u'Error writing %d queued audits', len(batch), exc_info=True)
+        finally:
+            close_old_connections()
+
+
+_lock = threading.Lock()
+_writer = None
+
+
+def get_writer():
+    """
+    Returns the writer thread of this process, starting it if needed. A process forked
+    from one that already had a writer gets its own.
+    """
+    global _writer
+    with _lock:
+        if _writer is None or _writer.pid != os.getpid() or not _writer.is_alive():
+            _writer = AuditWriterThread(
+                batch_size=settings.DJANGO_SIMPLE_AUDIT_WRITER_BATCH_SIZE,
+                flush_interval=settings.DJANGO_SIMPLE_AUDIT_WRITER_FLUSH_INTERVAL,
+                queue_size=settings.DJANGO_SIMPLE_AUDIT_WRITER_QUEUE_SIZE,
+                block=settings.DJANGO_SIMPLE_AUDIT_WRITER_BLOCK,
+            )
+            _writer.start()
+        return _writer
+
+
+def submit(entries):
+    get_writer().submit(entries)
+
+
+def shutdown(timeout=None):
+    """
+    Flushes the queued audits and stops the writer thread, if it is running.
+    """
+    global _writer
+    with _lock:
+        writer, _writer = _writer, None
+    if writer is not None and writer.pid == os.getpid() and writer.is_alive():
+        writer.stop(timeout)
+
+
+atexit.register(shutdown, settings.DJANGO_SIMPLE_AUDIT_WRITER_SHUTDOWN_TIMEOUT)
@@ -0,0 +1,267 @@
+# -*- coding:utf-8 -*-
+"""
+Persistence of audit rows.
+
+By default every audit is written inline, as soon as it is registered. When
+DJANGO_SIMPLE_AUDIT_BUFFERED_WRITES is set, audits registered inside a
+transaction are kept in memory and written with bulk_create from
+transaction.on_commit, so a transaction that touches many objects costs a
+couple of INSERTs instead of one per audit and per changed field. Buffered
+audits are dropped together with the transaction (or savepoint) that
+produced them when it is rolled back.
+
+With DJANGO_SIMPLE_AUDIT_REQUEST_BUFFER, the middleware keeps the audits of a
+request (once their transaction committed) in memory and
+writes them together with their AuditRequest when the response is returned.
+
+With DJANGO_SIMPLE_AUDIT_WRITER_THREAD, the audits of a committed transaction
+are handed to the writer thread of worker.py instead,
+and with DJANGO_SIMPLE_AUDIT_JOURNAL_DIR they are appended to the local
+journal of journal.py.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import contextvars
+import logging
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.db import router, transaction
+
+from . import checkpoints, feed, journal, search, settings, worker
+from .models import Audit, AuditChange
+
+LOG = logging.getLogger(__name__)
+
+# the audits of the current request, see start_request_buffer
+REQUEST_ENTRIES = contextvars.ContextVar("simple_audit_request_entries", default=None)
+# the PendingAudits of the current transactions, by database and savepoints
+PENDING = contextvars.ContextVar("simple_audit_pending", default=None)
+
+
+def bulk_write(entries, using=None):
+    """
+    Writes a list of (audit, changes) tuples, where audit is an unsaved Audit and
+    changes a list of unsaved AuditChange, using as few queries as the database allows.
+    """
+    if not entries:
+        return
+    using = using or router.db_for_write(Audit)
+    audits = [audit for audit, changes in entries]
+    with transaction.atomic(using=using):
+        for audit in audits:
+            if audit.audit_request_id is None and Audit.audit_request.is_cached(audit) \
+                    and audit.audit_request is not None:
+                audit.audit_request.ensure_saved(using=using)
+                # the audit was registered before its request was saved
+                audit.audit_request = audit.audit_request
+            audit.denormalize_request()
+
+        if transaction.get_connection(using).features.can_return_rows_from_bulk_insert:
+            Audit.objects.using(using).bulk_create(audits)
+        else:
+            # without RETURNING we would not know the ids to link the changes to
+            for audit in audits:
+                audit.save(using=using)
+
+        audit_changes = []
+        for audit, changes in entries:
+            for change in changes:
+                change.audit = audit
+                audit_changes.append(change)
+        if audit_changes:
+            AuditChange.objects.using(using).bulk_create(audit_changes)
+        search.index(entries, using)
+        checkpoints.write(entries, using)
+        feed.written(entries, using)
+    LOG.debug("bulk wrote %d audits with %d changes" % (len(audits), len(audit_changes)))
+
+
+def write(entries, using=None):
+    """
+    Writes (audit, changes) entries to the configured destination: the buffer of the
+    current request when it has one, the journal when DJANGO_SIMPLE_AUDIT_JOURNAL_DIR is
+    set, the writer thread when DJANGO_SIMPLE_AUDIT_WRITER_THREAD is set, or the database
+    right now.
+    """
+    request_entries = REQUEST_ENTRIES.get()
+    if request_entries is not None:
+        request_entries.extend(entries)
+    elif settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR and not settings.DJANGO_SIMPLE_AUDIT_JOURNAL_FALLBACK:
+        journal.append(entries)
+    elif settings.DJANGO_SIMPLE_AUDIT_WRITER_THREAD:
+        worker.submit(entries)
+    else:
+        bulk_write_or_spill(entries, using=using)
+
+
+async def awrite(entries, using=None):
+    """
+    Like write, from async code. Writing to the database takes a single thread hop for all
+    the entries; the other destinations only keep them in memory, append them to a file or
+    queue them.
+    """
+    if REQUEST_ENTRIES.get() is not None or settings.DJANGO_SIMPLE_AUDIT_WRITER_THREAD \
+            or (settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR and not settings.DJANGO_SIMPLE_AUDIT_JOURNAL_FALLBACK):
+        write(entries, using=using)
+    else:
+        await sync_to_async(bulk_write_or_spill)(entries, using=using)
+
+
+def bulk_write_or_spill(entries, using=None):
+    """
+    Writes entries to the database. If that fails and a journal is configured, they are
+    appended to the journal to be ingested later.
+    """
+    try:
+        bulk_write(entries, using=using)
+    except:
+        if not settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR:
+            raise
+        LOG.warning(u'Error writing %d audits, appending them to the journal', len(entries), exc_info=True)
+        journal.append(entries)
+
+
+def start_request_buffer():
+    """
+    Keeps the audits registered from now on in memory, until end_request_buffer is called.
+    """
+    REQUEST_ENTRIES.set([])
+
+
+def end_request_buffer(discard=False):
+    """
+    Writes the audits kept since start_request_buffer, together, or forgets them if discard.
+    """
+    entries = REQUEST_ENTRIES.get()
+    REQUEST_ENTRIES.set(None)
+    if entries and not discard:
+        write(entries)
+
+
+async def aend_request_buffer(discard=False):
+    """
+    Like end_request_buffer, from async code.
+    """
+    entries = REQUEST_ENTRIES.get()
+    REQUEST_ENTRIES.set(None)
+    if entries and not discard:
+        await awrite(entries)
+
+
+@asynccontextmanager
+async def abuffered():
+    """
+    Keeps the audits registered inside the block, by async code or by the sync code it
+    calls (like Model.asave), in memory and writes them together when the block ends.
+    They are discarded if the block raises an exception.
+    """
+    token = REQUEST_ENTRIES.set([])
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        entries = REQUEST_ENTRIES.get()
+        REQUEST_ENTRIES.reset(token)
+        if entries and not failed:
+            await awrite(entries)
+
+
+class PendingAudits(object):
+    """
+    Audits registered under the same savepoint of a transaction. The instance itself is
+    registered as on_commit callback, so Django discards it when that savepoint or the
+    whole transaction is rolled back.
+    """
+
+    def __init__(self, using):
+        self.using = using
+        self.entries = []
+        self.flushed = False
+
+    def is_pending(self):
+        if self.flushed:
+            return False
+        connection = transaction.get_connection(self.using)
+        return any(func is self for sids, func, robust in connection.run_on_commit)
+
+    def __call__(self):
+        self.flushed = True
+        entries, self.entries = self.entries, []
+        try:
+            write(entries, using=self.using)
+        except:
+            LOG.error(u'Error writing %d buffered audits', len(entries), exc_info=True)
+
+
+def _get_pending(using):
+    connection = transaction.get_connection(using)
+    key = (using, tuple(connection.savepoint_ids))
+    pending_by_key = PENDING.get()
+    if pending_by_key is None:
+        pending_by_key = {}
+        PENDING.set(pending_by_key)
+
+    pending = pending_by_key.get(key)
+    if pending is None or not pending.is_pending():
+        # forget buffers whose transaction was rolled back or already flushed
+        for stale_key in [k for k, p in pending_by_key.items() if not p.is_pending()]:
+            del pending_by_key[stale_key]
+        pending = pending_by_key[key] = PendingAudits(using)
+        transaction.on_commit(pending, using=using)
+    return pending
+
+
+def on_commit_only():
+    """
+    Whether the audits registered inside a transaction are kept until it commits, instead
+    of being written with it: buffered writes, and audits handed to the writer thread,
+    kept in the buffer of the request or appended to the journal, which would otherwise be
+    written even if the transaction is rolled back.
+    """
+    return settings.DJANGO_SIMPLE_AUDIT_BUFFERED_WRITES or settings.DJANGO_SIMPLE_AUDIT_WRITER_THREAD \
+        or REQUEST_ENTRIES.get() is not None \
+        or (settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR and not settings.DJANGO_SIMPLE_AUDIT_JOURNAL_FALLBACK)
+
+
+def persist(audit, changes):
+    """
+    Saves an unsaved audit and its unsaved changes, or keeps them until the current
+    transaction commits, see on_commit_only.
+    """
+    if on_commit_only():
+        using = router.db_for_write(Audit)
+        if transaction.get_connection(using).in_atomic_block:
+            _get_pending(using).entries.append((audit, changes))
+        else:
+            write([(audit, changes)], using=using)
+    elif settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR:
+        # written in bulk, and appended to the journal if that fails
+        write([(audit, changes)])
+    else:
+        if audit.audit_request is not None:
+            audit.audit_request.ensure_saved()
+            audit.audit_request = audit.audit_request
+            audit.denormalize_request()
+        audit.save()
+        for change in changes:
+            change.audit = audit
+            change.save()
+        search.index([(audit, changes)], audit._state.db)
+        checkpoints.write([(audit, changes)], audit._state.db)
+        feed.written([(audit, changes)], audit._state.db)
+
+
+def persist_many(entries):
+    """
+    Like persist, for a list of (audit, changes) entries, which are always written in bulk.
+    """
+    if not entries:
+        return
+    if on_commit_only():
+        using = router.db_for_write(Audit)
+        if transaction.get_connection(using).in_atomic_block:
+            _get_pending(using).entries.extend(entries)
+            return
+    write(entries)
@@ -4,16 +4,26 @@ import uuid
 from django.db import models
 from django.contrib.auth.models import User
 
+from simple_audit.managers import AuditedManager
+
 
 class Topping(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=50, blank=False, unique=True)
     description = models.TextField(null=True, blank=True)
 
+    objects = AuditedManager()
+
     def __str__(self):
         return self.name
 
 
+class SpecialTopping(Topping):
+
+    class Meta:
+        proxy = True
+
+
 class Pizza(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=50, blank=False, unique=True)
@@ -52,3 +62,6 @@ class VirtualMachine(models.Model):
 
     def __str__(self):
         return self.name
+
+    def get_audit_description(self):
+        return "%s (%d cpus)" % (self.name, self.cpus)
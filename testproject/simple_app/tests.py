@@ -5,15 +5,40 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import asyncio
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+
 from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import Permission, User
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
-
-from simple_audit import m2m_audit
+from django.core.cache import caches
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.urls import reverse
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase
+
+from simple_audit import export, journal, m2m_audit, revert, search, state, worker, writer
 from simple_audit import settings as audit_settings
-from simple_audit.models import Audit
+from simple_audit.archive import ArchiveReader
+from simple_audit.middleware import RequestPolicy, TrackingRequestOnThreadLocalMiddleware
+from simple_audit.models import Audit, AuditChange, AuditCheckpoint, AuditJournalSegment, AuditRequest
+from simple_audit.signal import asave_audit, register
 
-from .models import Pizza, Topping, Owner, VirtualMachine
+from .models import Pizza, SpecialTopping, Topping, Owner, VirtualMachine
 
 
 class SimpleTest(TestCase):
@@ -26,11 +51,6 @@ class SimpleTest(TestCase):
         self.content_type_pizza = ContentType.objects.get_for_model(Pizza)
         self.content_type_virtual_machine = ContentType.objects.get_for_model(VirtualMachine)
 
-    @staticmethod
-    def sort_dict_collection(list_):
-        """ Takes a list of dictionaries and orders them by key """
-        return sorted(list_, key=lambda x: list(x.keys())[0])
-
     def test_add_topping_and_search_audit(self):
         """tests add a topping"""
         topping = Topping.objects.get_or_create(name="potato")[0]
@@ -79,174 +99,101 @@ class SimpleTest(TestCase):
                                           description="Added peperoni"))
 
         # m2m audit recorded?
-        # u"field toppings.1.id: was changed from None to 1\nfield toppings.1.name: was changed from None to 'calabresa'"
-        desc = "field toppings.%s.id: was changed from None to %s\nfield toppings.%s.name: was changed from None to '%s'" % (
+        # u"field toppings.1: was changed from None to '1'"
+        desc = "field toppings.%s: was changed from None to '%s'" % (
             self.topping_onion.id,
-            self.topping_onion.id,
-            self.topping_onion.id,
-            self.topping_onion.name)
+            self.topping_onion.id)
 
         self.assertTrue(Audit.objects.get(operation=1,
                                           content_type=self.content_type_pizza,
                                           object_id=pizza.pk,
                                           description=desc))
 
-    def test_m2m_dict_diff_with_new_and_old_state_different(self):
-        """
-        test where old state and new state contains different elements
-        """
-
-        new_state = {u'toppings': [{u'id': 1, 'name': u'ceboloa'},
-                                   {u'id': 5, 'name': u'cogumelo'},
-                                   {u'id': 6, 'name': u'abobrinha'},
-                                   {u'id': 8, 'name': u'codorna'},
-                                   {u'id': 9, 'name': u'banana'},
-                                   {u'id': 10, 'name': u'abacaxi'},
-                                   ]}
-
-        old_state = {u'toppings': [{u'id': 1, 'name': u'ceboloa'},
-                                   {u'id': 5, 'name': u'cogumelo'},
-                                   {u'id': 6, 'name': u'abobrinha'},
-                                   {u'id': 8, 'name': u'codorna'},
-                                   {u'id': 9, 'name': u'banana'},
-                                   {u'id': 11, 'name': u'abacate'},
-                                   ]}
-
-        expected_response = [{u'toppings.10.id': [None, 10], u'toppings.10.name': [None, u'abacaxi']},
-                             {u'toppings.11.id': [11, None], u'toppings.11.name': [u'abacate', None]}]
-
-        expected_response = self.sort_dict_collection(expected_response)
-
-        diff = m2m_audit.m2m_dict_diff(old_state, new_state)
-        diff = self.sort_dict_collection(diff)
-
-        self.assertEqual(diff, expected_response)
-
-    def test_m2m_dict_diff_with_empty_new_state(self):
-        """
-        test where new state is an empty dict
-        """
-
-        new_state = {}
-
-        old_state = {u'toppings': [{u'id': 1, 'name': u'ceboloa'},
-                                   {u'id': 5, 'name': u'cogumelo'},
-                                   {u'id': 6, 'name': u'abobrinha'},
-                                   {u'id': 8, 'name': u'codorna'},
-                                   {u'id': 9, 'name': u'banana'},
-                                   {u'id': 11, 'name': u'abacate'},
-                                   ]}
-
-        expected_response = [{u'toppings.11.id': [11, None], u'toppings.11.name': [u'abacate', None]},
-                             {u'toppings.5.id': [5, None], u'toppings.5.name': [u'cogumelo', None]},
-                             {u'toppings.6.id': [6, None], u'toppings.6.name': [u'abobrinha', None]},
-                             {u'toppings.1.id': [1, None], u'toppings.1.name': [u'ceboloa', None]},
-                             {u'toppings.8.id': [8, None], u'toppings.8.name': [u'codorna', None]},
-                             {u'toppings.9.id': [9, None], u'toppings.9.name': [u'banana', None]}]
-
-        expected_response = self.sort_dict_collection(expected_response)
-
-        diff = m2m_audit.m2m_dict_diff(old_state, new_state)
-        diff = self.sort_dict_collection(diff)
-
-        self.assertEqual(diff, expected_response)
-
-    def test_m2m_dict_diff_with_empty_old_state(self):
-        """
-        test where old state is an empty dict
-        """
-
-        new_state = {u'toppings': [{u'id': 1, 'name': u'ceboloa'},
-                                   {u'id': 5, 'name': u'cogumelo'},
-                                   {u'id': 6, 'name': u'abobrinha'},
-                                   {u'id': 8, 'name': u'codorna'},
-                                   {u'id': 9, 'name': u'banana'},
-                                   {u'id': 10, 'name': u'abacaxi'},
-                                   ]}
-
-        old_state = {}
-
-        expected_response = [{u'toppings.10.id': [None, 10], u'toppings.10.name': [None, u'abacaxi']},
-                             {u'toppings.5.id': [None, 5], u'toppings.5.name': [None, u'cogumelo']},
-                             {u'toppings.6.id': [None, 6], u'toppings.6.name': [None, u'abobrinha']},
-                             {u'toppings.1.id': [None, 1], u'toppings.1.name': [None, u'ceboloa']},
-                             {u'toppings.8.id': [None, 8], u'toppings.8.name': [None, u'codorna']},
-                             {u'toppings.9.id': [None, 9], u'toppings.9.name': [None, u'banana']}]
-
-        expected_response = self.sort_dict_collection(expected_response)
-
-        diff = m2m_audit.m2m_dict_diff(old_state, new_state)
-        diff = self.sort_dict_collection(diff)
-
-        self.assertEqual(diff, expected_response)
-
-    def test_m2m_dict_diff_with_old_and_new_state_the_same(self):
-        """
-        test where old state and new state are the same. no change detected!
-        """
-
-        new_state = {u'toppings': [{u'id': 1, 'name': u'ceboloa'},
-                                   {u'id': 5, 'name': u'cogumelo'},
-                                   {u'id': 6, 'name': u'abobrinha'},
-                                   {u'id': 8, 'name': u'codorna'},
-                                   {u'id': 9, 'name': u'banana'},
-                                   {u'id': 10, 'name': u'abacaxi'},
-                                   ]}
-
-        old_state = {u'toppings': [{u'id': 1, 'name': u'ceboloa'},
-                                   {u'id': 5, 'name': u'cogumelo'},
-                                   {u'id': 6, 'name': u'abobrinha'},
-                                   {u'id': 8, 'name': u'codorna'},
-                                   {u'id': 9, 'name': u'banana'},
-                                   {u'id': 10, 'name': u'abacaxi'},
-                                   ]}
-
-        expected_response = []
-
-        diff = m2m_audit.m2m_dict_diff(old_state, new_state)
-
-        self.assertEqual(diff, expected_response)
-
-    def test_m2m_dict_multiple_field_diff(self):
-        """
-        test where old state and new state contains multiple fields,
-        with one field having a changed value
-        """
-
-        new_state = {
-            u'foo': [
-                {u'id': 1, 'name': u'bar'
-                 }
-            ],
-            u'toppings': [
-                {u'id': 1, 'name': u'ceboloa'},
-                {u'id': 5, 'name': u'cogumelo'},
-                {u'id': 6, 'name': u'abobrinha'},
-                {u'id': 8, 'name': u'codorna'},
-                {u'id': 9, 'name': u'banana'},
-                {u'id': 10, 'name': u'abcdef'},
-            ]
-        }
-
-        old_state = {
-            u'foo': [
-                {u'id': 1, 'name': u'bar'
-                 }
-            ],
-            u'toppings': [
-                {u'id': 1, 'name': u'ceboloa'},
-                {u'id': 5, 'name': u'cogumelo'},
-                {u'id': 6, 'name': u'abobrinha'},
-                {u'id': 8, 'name': u'codorna'},
-                {u'id': 9, 'name': u'banana'},
-                {u'id': 10, 'name': u'abcdesccc'},
-            ]
-        }
-
-        expected_response = [{u'toppings.10.name': [u'abcdesccc', u'abcdef']}]
-
-        diff = m2m_audit.m2m_dict_diff(old_state, new_state)
-        self.assertEqual(diff, expected_response)
+    def test_add_topping_to_pizza_records_only_the_added_pks(self):
+        """tests adding a topping does not load the toppings already in the pizza"""
+        pizza = Pizza.objects.create(name="calabresa")
+        pizza.toppings.add(self.topping_onion)
+
+        # select of the existing pks, insert, audit insert and change insert
+        with self.assertNumQueries(4):
+            pizza.toppings.add(self.topping_egg)
+
+        last_audit = Audit.objects.filter(operation=1, content_type=self.content_type_pizza,
+                                          object_id=pizza.pk).order_by('-date', '-id').first()
+        change = last_audit.field_changes.get()
+        self.assertEqual(change.field, "toppings.%s" % self.topping_egg.pk)
+        self.assertEqual(change.old_value, None)
+        self.assertEqual(change.new_value, str(self.topping_egg.pk))
+
+    def test_add_pizza_to_topping_audits_the_pizza(self):
+        """tests the reverse side of the m2m audits the pizza"""
+        pizza = Pizza.objects.create(name="portuguesa")
+        self.topping_egg.pizza_set.add(pizza)
+
+        last_audit = Audit.objects.get(operation=1, content_type=self.content_type_pizza, object_id=pizza.pk)
+        self.assertEqual(last_audit.field_changes.get().field, "toppings.%s" % self.topping_egg.pk)
+
+    def test_saving_pizza_does_not_read_its_toppings(self):
+        """tests a plain save does not capture the m2m relations"""
+        pizza = Pizza.objects.create(name="quattro formaggi")
+        pizza.toppings.add(self.topping_onion)
+
+        pizza.name = "quattro stagioni"
+        # old state, update, audit insert and change insert
+        with self.assertNumQueries(4):
+            pizza.save()
+
+    def test_remove_topping_from_pizza(self):
+        """tests removing toppings records the removed pks only"""
+        pizza = Pizza.objects.create(name="funghi")
+        pizza.toppings.add(self.topping_onion)
+        pizza.toppings.remove(self.topping_onion, self.topping_egg)
+
+        last_audit = Audit.objects.filter(operation=1, content_type=self.content_type_pizza,
+                                          object_id=pizza.pk).order_by('-date', '-id').first()
+        change = last_audit.field_changes.get()
+        self.assertEqual(change.field, "toppings.%s" % self.topping_onion.pk)
+        self.assertEqual(change.old_value, str(self.topping_onion.pk))
+        self.assertEqual(change.new_value, None)
+
+    def test_remove_unrelated_topping_is_not_audited(self):
+        pizza = Pizza.objects.create(name="bianca")
+        pizza.toppings.remove(self.topping_egg)
+
+        self.assertFalse(Audit.objects.filter(operation=1, content_type=self.content_type_pizza,
+                                              object_id=pizza.pk).exists())
+
+    def test_clear_toppings(self):
+        """tests clearing records every removed topping"""
+        pizza = Pizza.objects.create(name="capricciosa")
+        pizza.toppings.add(self.topping_onion, self.topping_egg)
+        pizza.toppings.clear()
+
+        last_audit = Audit.objects.filter(operation=1, content_type=self.content_type_pizza,
+                                          object_id=pizza.pk).order_by('-date', '-id').first()
+        self.assertEqual(sorted(last_audit.field_changes.values_list('field', 'new_value')),
+                         sorted([("toppings.%s" % self.topping_onion.pk, None),
+                                 ("toppings.%s" % self.topping_egg.pk, None)]))
+
+    def test_clear_pizzas_of_topping_audits_each_pizza(self):
+        """tests clearing the reverse side audits each pizza"""
+        pizzas = [Pizza.objects.create(name="diavola"), Pizza.objects.create(name="ortolana")]
+        self.topping_egg.pizza_set.add(*pizzas)
+        self.topping_egg.pizza_set.clear()
+
+        for pizza in pizzas:
+            change = Audit.objects.filter(operation=1, content_type=self.content_type_pizza, object_id=pizza.pk,
+                                          field_changes__new_value=None).get().field_changes.get()
+            self.assertEqual(change.field, "toppings.%s" % self.topping_egg.pk)
+
+    def test_m2m_set_diff(self):
+        """tests diff of m2m pk sets"""
+        old_state = {'toppings': {1, 5}}
+        new_state = {'toppings': {1, 6}}
+
+        self.assertEqual(m2m_audit.m2m_set_diff(old_state, new_state),
+                         {'toppings.5': ('5', None), 'toppings.6': (None, '6')})
+        self.assertEqual(m2m_audit.m2m_set_diff(old_state, old_state), {})
 
     def test_field_changes_for_nullable_values(self):
         """tests add a topping with none description"""
@@ -302,3 +249,1250 @@ class SimpleTest(TestCase):
         assert last_audit.field_changes.filter(field='cpus').exists()
         assert last_audit.field_changes.filter(field='owner').exists()
         assert not last_audit.field_changes.filter(field='started').exists()
+
+    def test_foreign_key_is_audited_without_loading_related_object(self):
+        """tests the owner is audited from owner_id"""
+        owner = Owner.objects.create(name='Ionel')
+
+        # virtual machine insert, audit insert and one insert per audited field
+        with self.assertNumQueries(7):
+            vm = VirtualMachine.objects.create(name='VM1', cpus=4, owner_id=owner.pk, started=True)
+
+        last_audit = Audit.objects.get(content_type=self.content_type_virtual_machine, object_id=vm.pk)
+        self.assertEqual(last_audit.field_changes.get(field='owner').new_value, str(owner.pk))
+
+    def test_object_description_is_stored(self):
+        topping = Topping.objects.create(name="marjoram")
+        owner = Owner.objects.create(name='Ionel')
+        vm = VirtualMachine.objects.create(name='VM1', cpus=4, owner=owner, started=True)
+
+        self.assertEqual(Audit.objects.get(object_id=topping.pk).obj_description, "marjoram")
+        self.assertEqual(Audit.objects.get(object_id=vm.pk).obj_description, "VM1 (4 cpus)")
+
+    def test_m2m_relations_are_not_part_of_the_state(self):
+        """tests added pizza audit does not include the toppings manager"""
+        pizza = Pizza.objects.create(name="marguerita")
+
+        last_audit = Audit.objects.get(content_type=self.content_type_pizza, object_id=pizza.pk)
+        self.assertEqual(sorted(last_audit.field_changes.values_list('field', flat=True)), ['id', 'name'])
+
+
+class AuditUserTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("cook")
+
+    def test_user_and_request_are_copied_onto_the_audit(self):
+        audit_request = AuditRequest.new_request("/toppings/", self.user, "127.0.0.1")
+        try:
+            topping = Topping.objects.create(name="cress")
+        finally:
+            AuditRequest.cleanup_request()
+
+        audit = Audit.objects.get(object_id=topping.pk)
+        self.assertEqual(audit.user_id, self.user.pk)
+        self.assertEqual(audit.request_id, audit_request.request_id)
+
+    def test_backfill(self):
+        AuditRequest.new_request("/toppings/", self.user, "127.0.0.1")
+        try:
+            topping = Topping.objects.create(name="sorrel")
+        finally:
+            AuditRequest.cleanup_request()
+        Audit.objects.update(user=None, request_id=None)
+
+        call_command("backfill_audit_users", batch_size=1, stdout=StringIO())
+
+        audit = Audit.objects.get(object_id=topping.pk)
+        self.assertEqual(audit.user_id, self.user.pk)
+        self.assertEqual(audit.request_id, audit.audit_request.request_id)
+
+
+class HistoryTest(TestCase):
+
+    def test_history_is_newest_first(self):
+        topping = Topping.objects.create(name="ginger")
+        topping.description = "fresh"
+        topping.save()
+        Topping.objects.create(name="turmeric")
+
+        self.assertEqual(list(Audit.objects.history(topping).values_list("operation", flat=True)),
+                         [Audit.CHANGE, Audit.ADD])
+
+    def test_history_does_not_sort(self):
+        topping = Topping.objects.create(name="saffron")
+
+        plan = Audit.objects.history(topping).explain()
+        self.assertIn("audit_history_idx", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND = "simple_audit.search.SQLiteSearchBackend"
+        search.get_backend().create("default")
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND = None
+
+    def test_search_description_and_changes(self):
+        topping = Topping.objects.create(name="coriander")
+        topping.name = "cilantro"
+        topping.save()
+        Topping.objects.create(name="oregano")
+
+        self.assertEqual(set(Audit.objects.search("corian").values_list("operation", flat=True)),
+                         set([Audit.ADD, Audit.CHANGE]))
+        self.assertEqual(Audit.objects.search("cilantro").count(), 1)
+        self.assertFalse(Audit.objects.search("basil").exists())
+        # FTS5 syntax in the query is taken literally
+        self.assertFalse(Audit.objects.search('"coriander" OR NEAR(').exists())
+
+    def test_search_without_backend(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND = None
+        Topping.objects.create(name="fennel")
+
+        self.assertEqual(Audit.objects.search("fenn").count(), 1)
+
+    def test_admin_search(self):
+        Topping.objects.create(name="tarragon")
+        Topping.objects.create(name="thyme")
+        user = User.objects.create_superuser("searcher", "searcher@example.com", "secret")
+        self.client.force_login(user)
+
+        response = self.client.get(reverse("admin:simple_audit_audit_changelist"), {"q": "tarragon"})
+        self.assertEqual([audit.get_description() for audit in response.context["cl"].result_list],
+                         ["Added tarragon"])
+
+    def test_admin_search_by_request_id_and_object_id(self):
+        AuditRequest.new_request("/toppings/", None, "127.0.0.1")
+        try:
+            tarragon = Topping.objects.create(name="tarragon")
+            request_id = AuditRequest.current_request().request_id
+        finally:
+            AuditRequest.cleanup_request()
+        thyme = Topping.objects.create(name="thyme")
+        user = User.objects.create_superuser("searcher", "searcher@example.com", "secret")
+        self.client.force_login(user)
+
+        for term, topping in ((request_id, tarragon), (str(thyme.pk), thyme)):
+            response = self.client.get(reverse("admin:simple_audit_audit_changelist"), {"q": term})
+            self.assertEqual([audit.object_id for audit in response.context["cl"].result_list], [topping.pk])
+
+    def test_rebuild(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND = None
+        Topping.objects.create(name="sumac")
+        audit_settings.DJANGO_SIMPLE_AUDIT_SEARCH_BACKEND = "simple_audit.search.SQLiteSearchBackend"
+        self.assertFalse(Audit.objects.search("sumac").exists())
+
+        call_command("rebuild_audit_search", batch_size=1, stdout=StringIO())
+        self.assertEqual(Audit.objects.search("sumac").count(), 1)
+
+    def test_rebuild_keeps_the_index(self):
+        Topping.objects.create(name="galangal")
+
+        # audits already indexed are replaced, not duplicated, and the table is not dropped
+        call_command("rebuild_audit_search", stdout=StringIO())
+        call_command("rebuild_audit_search", stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM audit_search WHERE audit_search MATCH 'galangal'")
+            self.assertEqual(cursor.fetchone()[0], 1)
+        Topping.objects.create(name="lemongrass")
+        self.assertEqual(Audit.objects.search("lemongrass").count(), 1)
+
+    def test_backend_is_abstract(self):
+        with self.assertRaises(TypeError):
+            search.SearchBackend()
+
+
+class RetentionTest(TestCase):
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_RETENTION = {"*": 30, "simple_app.topping": None}
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_RETENTION = {}
+        AuditRequest.cleanup_request()
+        shutil.rmtree(self.directory)
+
+    def create_old(self):
+        AuditRequest.new_request("/old/", None, "127.0.0.1")
+        owner = Owner.objects.create(name="Alice")
+        owner.name = "Alicia"
+        owner.save()
+        topping = Topping.objects.create(name="sage")
+        AuditRequest.cleanup_request()
+        Audit.objects.update(date=timezone.now() - timedelta(days=60))
+
+        AuditRequest.new_request("/new/", None, "127.0.0.1")
+        recent = Owner.objects.create(name="Bob")
+        AuditRequest.cleanup_request()
+        return owner, topping, recent
+
+    def test_prune(self):
+        owner, topping, recent = self.create_old()
+
+        call_command("prune_audits", batch_size=1, stdout=StringIO())
+
+        self.assertFalse(Audit.objects.filter(object_id=owner.pk).exists())
+        self.assertFalse(AuditChange.objects.filter(audit__object_id=owner.pk).exists())
+        self.assertTrue(Audit.objects.filter(object_id=topping.pk).exists())
+        self.assertTrue(Audit.objects.filter(object_id=recent.pk).exists())
+        # the old request still has the audit of the topping
+        self.assertEqual(set(AuditRequest.objects.values_list("path", flat=True)), {"/old/", "/new/"})
+
+        audit_settings.DJANGO_SIMPLE_AUDIT_RETENTION = {"*": 30}
+        call_command("prune_audits", stdout=StringIO())
+        self.assertEqual(list(AuditRequest.objects.values_list("path", flat=True)), ["/new/"])
+
+    def test_archive(self):
+        owner, topping, recent = self.create_old()
+
+        call_command("prune_audits", archive_dir=self.directory, stdout=StringIO())
+
+        events = []
+        for name in sorted(os.listdir(self.directory)):
+            with gzip.open(os.path.join(self.directory, name), "rt") as archive:
+                events.extend(json.loads(line) for line in archive)
+        self.assertEqual([event["operation"] for event in events], [Audit.ADD, Audit.CHANGE])
+        self.assertEqual(events[1]["changes"], [["name", "Alice", "Alicia"]])
+
+        journal.load_events(events)
+        self.assertEqual(Audit.objects.filter(object_id=owner.pk).count(), 2)
+
+    def test_columnar_archive(self):
+        owner, topping, recent = self.create_old()
+        other = Owner.objects.create(name="Carol")
+        Audit.objects.filter(object_id=other.pk).update(date=timezone.now() - timedelta(days=60))
+
+        call_command("prune_audits", archive_dir=self.directory, archive_format="columnar",
+                     batch_size=2, stdout=StringIO())
+
+        reader = ArchiveReader(self.directory)
+        self.assertEqual(len(reader.chunks), 2)
+        history = reader.history(owner)
+        self.assertEqual([audit.operation for audit in history], [Audit.CHANGE, Audit.ADD])
+        self.assertEqual(history[0].changes, [("name", "Alice", "Alicia")])
+        self.assertEqual(history[0].obj_description, "Alicia")
+        self.assertEqual(history[0].request["path"], "/old/")
+        self.assertEqual([audit.object_id for audit in reader.history(other)], [str(other.pk)])
+        self.assertEqual(reader.history(topping), [])
+        self.assertEqual(len(reader.find("simple_app.owner", since=timezone.now() - timedelta(days=90))), 3)
+
+    def test_columnar_lookup_skips_chunks(self):
+        owner, topping, recent = self.create_old()
+        call_command("prune_audits", archive_dir=self.directory, archive_format="columnar", stdout=StringIO())
+        reader = ArchiveReader(self.directory)
+        chunk, = reader.chunks
+
+        self.assertFalse(chunk.may_contain("simple_app.pizza"))
+        self.assertFalse(chunk.may_contain("simple_app.owner", recent.pk))
+        self.assertEqual(reader.history(recent), [])
+        # nothing was decompressed
+        self.assertEqual(chunk._columns, {})
+
+    def test_proxy_model_policy(self):
+        owner, topping, recent = self.create_old()
+        special = SpecialTopping.objects.create(name="marigold")
+        Audit.objects.filter(object_id=special.pk).update(date=timezone.now() - timedelta(days=60))
+        audit_settings.DJANGO_SIMPLE_AUDIT_RETENTION = {"*": None, "simple_app.specialtopping": 30}
+
+        call_command("prune_audits", stdout=StringIO())
+
+        self.assertFalse(Audit.objects.filter(object_id__in=[topping.pk, special.pk]).exists())
+        self.assertTrue(Audit.objects.filter(object_id=owner.pk).exists())
+
+    def test_dry_run(self):
+        self.create_old()
+        out = StringIO()
+
+        call_command("prune_audits", dry_run=True, stdout=out)
+
+        self.assertIn("2 audits expired", out.getvalue())
+        self.assertEqual(Audit.objects.count(), 4)
+
+
+class ExportTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("exporter")
+        AuditRequest.new_request("/owners/", self.user, "127.0.0.1")
+        self.owner = Owner.objects.create(name="Dana")
+        self.owner.name = "Daniela"
+        self.owner.save()
+        AuditRequest.cleanup_request()
+        self.topping = Topping.objects.create(name="mint")
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_jsonl(self):
+        out = StringIO()
+        call_command("export_audits", format="jsonl", content_type=["simple_app.owner"], stdout=out)
+
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([row["operation"] for row in rows], ["add", "change"])
+        self.assertEqual(rows[1]["changes"], [{"field": "name", "old_value": "Dana", "new_value": "Daniela"}])
+        self.assertEqual(rows[1]["object_id"], str(self.owner.pk))
+        self.assertEqual(rows[1]["path"], "/owners/")
+        self.assertEqual(rows[1]["user_id"], self.user.pk)
+
+    def test_csv_gzip_filters(self):
+        path = os.path.join(self.directory, "audits.csv.gz")
+        call_command("export_audits", output=path, gzip=True, user="exporter", operation=["change"],
+                     since=str(timezone.now().date()), stderr=StringIO())
+
+        with gzip.open(path, "rt", newline="") as export_file:
+            rows = list(csv.DictReader(export_file))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]["content_type"], "simple_app.owner")
+        self.assertEqual(json.loads(rows[0]["changes"]), [["name", "Dana", "Daniela"]])
+
+    def test_changes_are_read_per_chunk(self):
+        for name in ("nutmeg", "clove", "allspice"):
+            Topping.objects.create(name=name)
+        audits = Audit.objects.filter(content_type=ContentType.objects.get_for_model(Topping))
+
+        with CaptureQueriesContext(connection) as queries:
+            rows = list(export.rows(audits, chunk_size=2))
+        self.assertEqual([row["obj_description"] for row in rows], ["mint", "nutmeg", "clove", "allspice"])
+        # one query for the audits, fetched in chunks, and one for the changes of each chunk
+        self.assertEqual(len(queries), 3)
+
+
+class CheckpointTest(TestCase):
+
+    def setUp(self):
+        self.owner = Owner.objects.create(name="Erin")
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL = 0
+
+    def create_history(self):
+        vm = VirtualMachine.objects.create(name="web", cpus=2, owner=self.owner, so="linux", started=False)
+        moments = [timezone.now()]
+        for cpus in range(3, 8):
+            vm.cpus = cpus
+            vm.save()
+            moments.append(timezone.now())
+        return vm, moments
+
+    def test_as_of(self):
+        before = timezone.now()
+        vm, moments = self.create_history()
+
+        self.assertIsNone(Audit.objects.as_of(vm, before))
+        first = Audit.objects.as_of(vm, moments[0])
+        self.assertEqual((first.pk, first.name, first.cpus, first.owner_id), (vm.pk, "web", 2, self.owner.pk))
+        self.assertEqual(Audit.objects.as_of(vm, moments[3]).cpus, 5)
+
+        pk = vm.pk
+        vm.delete()
+        vm.pk = pk
+        self.assertEqual(Audit.objects.as_of(vm, moments[-1]).cpus, 7)
+        self.assertIsNone(Audit.objects.as_of(vm, timezone.now()))
+
+    def test_checkpoints_bound_the_replay(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL = 2
+        vm, moments = self.create_history()
+
+        checkpoints = AuditCheckpoint.objects.filter(object_id=vm.pk).order_by("date")
+        self.assertEqual([json.loads(checkpoint.state)["cpus"] for checkpoint in checkpoints], ["3", "5", "7"])
+        self.assertNotIn("started", json.loads(checkpoints[0].state))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Audit.objects.as_of(vm, moments[3]).cpus, 5)
+        # the checkpoint, the audits after it (none) and no changes to prefetch
+        self.assertEqual(len(queries), 2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Audit.objects.as_of(vm, moments[4]).cpus, 6)
+        self.assertEqual(len(queries), 3)
+
+    def test_checkpoints_of_a_batch_take_one_query(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL = 1
+
+        with CaptureQueriesContext(connection) as queries:
+            toppings = Topping.objects.bulk_create([Topping(name="herb%d" % i) for i in range(5)])
+        self.assertEqual(len([query for query in queries if 'ROW_NUMBER' in query["sql"]]), 1)
+        self.assertEqual(AuditCheckpoint.objects.filter(object_id__in=[t.pk for t in toppings]).count(), 5)
+
+
+class RevertTest(TestCase):
+
+    def setUp(self):
+        self.owner = Owner.objects.create(name="Fay")
+        self.vm = VirtualMachine.objects.create(name="db", cpus=2, owner=self.owner, so="linux", started=True)
+        self.spare = Owner.objects.create(name="Gus")
+        self.spare_pk = self.spare.pk
+
+    def tearDown(self):
+        AuditRequest.cleanup_request()
+
+    def mass_edit(self):
+        audit_request = AuditRequest.new_request("/mass-edit/", None, "127.0.0.1")
+        self.vm.cpus = 16
+        self.vm.save()
+        self.vm.name = "db-large"
+        self.vm.save()
+        self.spare.delete()
+        topping = Topping.objects.create(name="chive")
+        AuditRequest.cleanup_request()
+        return AuditRequest.objects.get(pk=audit_request.pk), topping
+
+    def test_revert_request(self):
+        audit_request, topping = self.mass_edit()
+
+        self.assertEqual(revert.revert_request(audit_request), 3)
+
+        vm = VirtualMachine.objects.get(pk=self.vm.pk)
+        self.assertEqual((vm.name, vm.cpus), ("db", 2))
+        self.assertEqual(Owner.objects.get(pk=self.spare_pk).name, "Gus")
+        self.assertFalse(Topping.objects.filter(pk=topping.pk).exists())
+        # the revert is audited too
+        self.assertEqual(Audit.objects.history(vm).first().field_changes.get(field="cpus").new_value, "2")
+
+    def test_revert_is_atomic(self):
+        audit_request, topping = self.mass_edit()
+        VirtualMachine.objects.filter(pk=self.vm.pk).delete()
+
+        with self.assertRaises(revert.RevertError):
+            revert.revert(Audit.objects.filter(audit_request=audit_request))
+        self.assertTrue(Topping.objects.filter(pk=topping.pk).exists())
+        self.assertFalse(Owner.objects.filter(pk=self.spare_pk).exists())
+
+    def test_unaudited_required_field(self):
+        self.vm.delete()
+
+        with self.assertRaises(revert.RevertError):
+            revert.revert(Audit.objects.filter(operation=Audit.DELETE))
+
+    def test_changes_are_read_at_once(self):
+        audit_request = AuditRequest.new_request("/mass-edit/", None, "127.0.0.1")
+        vms = [VirtualMachine.objects.create(name="vm%d" % i, cpus=1, owner=self.owner, so="linux", started=True)
+               for i in range(5)]
+        AuditRequest.cleanup_request()
+        audits = Audit.objects.filter(audit_request__request_id=audit_request.request_id)
+
+        with CaptureQueriesContext(connection) as queries:
+            revert.revert(audits)
+        selects = [query["sql"] for query in queries if query["sql"].startswith("SELECT")]
+        self.assertIn('FROM "audit"', selects[0])
+        self.assertIn('FROM "audit_change"', selects[1])
+        self.assertIn('FROM "simple_app_virtualmachine"', selects[2])
+        self.assertFalse(VirtualMachine.objects.filter(pk__in=[vm.pk for vm in vms]).exists())
+
+    def test_admin_action(self):
+        audit_request, topping = self.mass_edit()
+        user = User.objects.create_superuser("reverter", "reverter@example.com", "secret")
+        self.client.force_login(user)
+        audit = Audit.objects.filter(audit_request=audit_request).first()
+
+        response = self.client.post(reverse("admin:simple_audit_audit_changelist"), {
+            "action": "revert_requests", "_selected_action": [audit.pk],
+        })
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(VirtualMachine.objects.get(pk=self.vm.pk).cpus, 2)
+
+    def test_admin_revert_needs_the_permissions_of_the_reverted_objects(self):
+        audit_request, topping = self.mass_edit()
+        user = User.objects.create_user("reverter", "reverter@example.com", "secret", is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename="view_audit"))
+        self.client.force_login(user)
+        audit = Audit.objects.filter(audit_request=audit_request).first()
+
+        def revert_request():
+            return self.client.post(reverse("admin:simple_audit_audit_changelist"), {
+                "action": "revert_requests", "_selected_action": [audit.pk],
+            }, follow=True)
+
+        # the action needs the change permission of audits
+        revert_request()
+        self.assertEqual(VirtualMachine.objects.get(pk=self.vm.pk).cpus, 16)
+
+        # and the permissions to change the objects, add back the deleted owner and delete the added topping
+        user.user_permissions.add(*Permission.objects.filter(codename__in=[
+            "change_audit", "change_virtualmachine", "change_owner", "add_owner", "change_topping",
+        ]))
+        response = revert_request()
+        self.assertIn("permission", [str(message) for message in response.context["messages"]][0])
+        self.assertEqual(VirtualMachine.objects.get(pk=self.vm.pk).cpus, 16)
+
+        user.user_permissions.add(Permission.objects.get(codename="delete_topping"))
+        revert_request()
+        self.assertEqual(VirtualMachine.objects.get(pk=self.vm.pk).cpus, 2)
+        self.assertFalse(Topping.objects.filter(pk=topping.pk).exists())
+
+    def test_admin_revert_change_errors(self):
+        self.mass_edit()
+        user = User.objects.create_superuser("reverter", "reverter@example.com", "secret")
+        self.client.force_login(user)
+        audit = Audit.objects.filter(object_id=self.vm.pk, operation=Audit.CHANGE).first()
+        VirtualMachine.objects.filter(pk=self.vm.pk).delete()
+
+        response = self.client.get(reverse("admin:simple_audit_audit_revert", args=[audit.pk]), follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("does not exist", [str(message) for message in response.context["messages"]][0])
+
+        response = self.client.get(reverse("admin:simple_audit_audit_revert", args=[0]))
+        self.assertEqual(response.status_code, 404)
+
+
+class FeedTest(TestCase):
+    template = Template(
+        "{% load audit %}{% get_audit_log 3 as log %}"
+        "{% for audit in log %}{{ audit|audit_description|safe }};{% endfor %}"
+    )
+    user_template = Template(
+        "{% load audit %}{% get_audit_log 3 as log for_user cook %}"
+        "{% for audit in log %}{{ audit.obj_description }};{% endfor %}"
+    )
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_FEED_CACHE = "default"
+        caches["default"].clear()
+        self.user = User.objects.create_user("chef")
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_FEED_CACHE = None
+        audit_settings.DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES = False
+        AuditRequest.cleanup_request()
+        caches["default"].clear()
+
+    def create(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Topping.objects.create(name=name)
+
+    def test_feed_is_updated_without_queries(self):
+        self.create("lovage")
+        self.assertEqual(self.template.render(Context()), "Added lovage;Added chef;")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.template.render(Context()), "Added lovage;Added chef;")
+
+        self.create("borage")
+        topping = self.create("chervil")
+        with self.captureOnCommitCallbacks(execute=True):
+            topping.name = "burnet"
+            topping.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.template.render(Context()).split(";")[1:3], ["Added chervil", "Added borage"])
+
+    def test_structured_changes(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES = True
+        topping = self.create("hyssop")
+        self.template.render(Context())
+        with self.captureOnCommitCallbacks(execute=True):
+            topping.description = "minty"
+            topping.save()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.template.render(Context()).split(";")[0],
+                             "field description: was changed from None to 'minty'")
+
+    def test_user_feed(self):
+        self.user_template.render(Context({"cook": self.user}))
+        AuditRequest.new_request("/toppings/", self.user, "127.0.0.1")
+        self.create("savory")
+        AuditRequest.cleanup_request()
+        self.create("marjoram")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.user_template.render(Context({"cook": self.user})), "savory;")
+
+
+class AuditAdminTest(TestCase):
+
+    def setUp(self):
+        self.model_admin = admin.site._registry[Audit]
+        self.model_admin.list_per_page = 2
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+        for name in ("rosemary", "oregano", "parsley"):
+            Topping.objects.create(name=name)
+
+    def tearDown(self):
+        self.model_admin.list_per_page = 100
+        audit_settings.DJANGO_SIMPLE_AUDIT_ADMIN_COUNT_LIMIT = 10000
+
+    def changelist(self, query=""):
+        response = self.client.get(reverse("admin:simple_audit_audit_changelist") + query)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_older_pages_follow_the_cursor(self):
+        audits = list(Audit.objects.order_by("-date", "-id"))
+
+        self.assertGreater(len(audits), 2)
+
+        pages = []
+        next_page_url = ""
+        while next_page_url is not None:
+            cl = self.changelist(next_page_url).context["cl"]
+            pages.append(list(cl.result_list))
+            next_page_url = cl.next_page_url()
+
+        self.assertEqual(pages[0], audits[:2])
+        self.assertEqual(sum(pages, []), audits)
+
+    def test_count_is_capped(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_ADMIN_COUNT_LIMIT = 2
+
+        response = self.changelist()
+        self.assertEqual(response.context["cl"].result_count, 2)
+        self.assertContains(response, "2+ ")
+
+    def test_objects_without_description_are_read_once_per_model(self):
+        Audit.objects.update(obj_description="")
+
+        with CaptureQueriesContext(connection) as queries:
+            self.changelist()
+        topping_queries = [query for query in queries if "simple_app_topping" in query["sql"]]
+        self.assertEqual(len(topping_queries), 1)
+
+    def test_user_filter_does_not_join_the_request(self):
+        user = User.objects.get(username="admin")
+        AuditRequest.new_request("/toppings/", user, "127.0.0.1")
+        try:
+            topping = Topping.objects.create(name="chives")
+        finally:
+            AuditRequest.cleanup_request()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.changelist("?user=%d" % user.pk)
+        self.assertEqual([audit.object_id for audit in response.context["cl"].result_list], [topping.pk])
+        self.assertFalse([query for query in queries if 'JOIN "audit_request"' in query["sql"]])
+
+    def test_invalid_cursor_is_ignored(self):
+        response = self.changelist("?cursor=yesterday")
+        self.assertEqual(len(response.context["cl"].result_list), 2)
+
+
+class BufferedWritesTest(TestCase):
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_BUFFERED_WRITES = True
+        self.content_type_topping = ContentType.objects.get_for_model(Topping)
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_BUFFERED_WRITES = False
+
+    def test_audits_are_written_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            topping = Topping.objects.create(name="olive")
+            topping.description = "green"
+            topping.save()
+            # nothing written until the transaction commits
+            self.assertFalse(Audit.objects.filter(object_id=topping.pk).exists())
+
+        self.assertEqual(len(callbacks), 1)
+        # savepoint, audits, changes and release
+        with self.assertNumQueries(4):
+            callbacks[0]()
+
+        audits = Audit.objects.filter(content_type=self.content_type_topping, object_id=topping.pk)
+        self.assertEqual(sorted(audits.values_list("operation", flat=True)), [Audit.ADD, Audit.CHANGE])
+        change = audits.get(operation=Audit.CHANGE).field_changes.get(field="description")
+        self.assertIsNone(change.old_value)
+        self.assertEqual(change.new_value, "green")
+
+    def test_audits_of_rolled_back_savepoint_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            kept = Topping.objects.create(name="corn")
+            try:
+                with transaction.atomic():
+                    dropped = Topping.objects.create(name="tuna")
+                    Topping.objects.create(name="tuna")
+            except IntegrityError:
+                pass
+
+        self.assertTrue(Audit.objects.filter(object_id=kept.pk).exists())
+        self.assertFalse(Audit.objects.filter(object_id=dropped.pk).exists())
+
+    def test_deleted_objects_are_audited(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            topping = Topping.objects.create(name="radish")
+        pk = topping.pk
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                other = Topping.objects.create(name="turnip")
+                topping.delete()
+
+        self.assertEqual(list(Audit.objects.filter(object_id=pk).order_by("id").values_list("operation", flat=True)),
+                         [Audit.ADD, Audit.DELETE])
+        self.assertTrue(Audit.objects.filter(object_id=other.pk).exists())
+
+
+class TransactionStateTest(TestCase):
+
+    def test_state_is_kept_until_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            state.put("default", "key", 1)
+            self.assertEqual(state.get("default", "key"), 1)
+
+        self.assertIsNone(state.get("default", "key"))
+
+    def test_state_of_rolled_back_savepoint_is_forgotten(self):
+        state.put("default", "kept", 1)
+        try:
+            with transaction.atomic():
+                state.put("default", "dropped", 2)
+                raise IntegrityError
+        except IntegrityError:
+            pass
+
+        self.assertEqual(state.get("default", "kept"), 1)
+        self.assertIsNone(state.get("default", "dropped"))
+
+
+class StructuredChangesTest(TestCase):
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES = True
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_STRUCTURED_CHANGES = False
+
+    def test_change_description_is_rendered_when_read(self):
+        topping = Topping.objects.create(name="garlic")
+        topping.description = "strong"
+        topping.save()
+
+        audit = Audit.objects.get(object_id=topping.pk, operation=Audit.CHANGE)
+        self.assertEqual(audit.description, "")
+        self.assertEqual(audit.get_description(), "field description: was changed from None to 'strong'")
+
+    def test_add_description_is_stored(self):
+        topping = Topping.objects.create(name="basil")
+
+        audit = Audit.objects.get(object_id=topping.pk, operation=Audit.ADD)
+        self.assertEqual(audit.description, "Added basil")
+        self.assertEqual(audit.get_description(), "Added basil")
+
+    def test_descriptions_of_many_audits_are_rendered_from_prefetched_changes(self):
+        for name in ("chili", "paprika"):
+            topping = Topping.objects.create(name=name)
+            topping.description = "hot"
+            topping.save()
+
+        audits = list(Audit.objects.filter(operation=Audit.CHANGE).prefetch_related("field_changes"))
+        with self.assertNumQueries(0):
+            descriptions = [audit.get_description() for audit in audits]
+        self.assertEqual(descriptions, ["field description: was changed from None to 'hot'"] * 2)
+
+
+class RequestBufferTest(TestCase):
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_REQUEST_BUFFER = True
+        ContentType.objects.get_for_model(Topping)
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_REQUEST_BUFFER = False
+        writer.end_request_buffer(discard=True)
+
+    def post(self, view):
+        request = RequestFactory().post("/toppings/")
+        request.user = AnonymousUser()
+        return TrackingRequestOnThreadLocalMiddleware(convert_exception_to_response(view))(request)
+
+    def test_audits_are_written_with_the_response(self):
+        names = ["anchovy", "caper", "fennel", "pea", "sage"]
+
+        def view(request):
+            # the audits reach the request buffer when the transaction commits
+            with self.captureOnCommitCallbacks(execute=True):
+                for name in names:
+                    Topping.objects.create(name=name)
+            self.assertFalse(Audit.objects.exists())
+            return HttpResponse()
+
+        # five toppings and the check in the view, then savepoint, request, audits, changes and release
+        with self.assertNumQueries(11):
+            self.post(view)
+
+        audit_request = AuditRequest.objects.get()
+        self.assertEqual(audit_request.path, "/toppings/")
+        self.assertEqual(Audit.objects.filter(audit_request=audit_request).count(), len(names))
+
+    def test_audits_of_failed_view_are_discarded(self):
+        def view(request):
+            Topping.objects.create(name="thyme")
+            raise ValueError
+
+        self.assertEqual(self.post(view).status_code, 500)
+
+        self.assertFalse(Audit.objects.exists())
+        self.assertFalse(AuditRequest.objects.exists())
+
+    def test_view_deleting_an_object(self):
+        topping = Topping.objects.create(name="garlic")
+        pk = topping.pk
+
+        def view(request):
+            with self.captureOnCommitCallbacks(execute=True):
+                Topping.objects.create(name="shallot")
+                topping.delete()
+            return HttpResponse()
+
+        self.post(view)
+
+        audit_request = AuditRequest.objects.get()
+        self.assertEqual(sorted(Audit.objects.filter(audit_request=audit_request).values_list("operation", flat=True)),
+                         [Audit.ADD, Audit.DELETE])
+        self.assertTrue(Audit.objects.filter(object_id=pk, operation=Audit.DELETE).exists())
+
+    def test_audits_of_rolled_back_savepoint_are_discarded(self):
+        def view(request):
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        Topping.objects.create(name="lovage")
+                        raise ValueError
+                except ValueError:
+                    pass
+                Topping.objects.create(name="sorrel")
+            return HttpResponse()
+
+        self.post(view)
+
+        self.assertEqual(list(Audit.objects.values_list("obj_description", flat=True)), ["sorrel"])
+
+
+class RequestPolicyTest(TestCase):
+
+    def request(self, method, path):
+        request = getattr(RequestFactory(), method.lower())(path)
+        request.user = AnonymousUser()
+        return request
+
+    def test_default_policy_skips_get(self):
+        policy = RequestPolicy(skip_methods=("GET",))
+
+        self.assertFalse(policy.should_track(self.request("GET", "/toppings/")))
+        self.assertTrue(policy.should_track(self.request("POST", "/toppings/")))
+
+    def test_paths(self):
+        policy = RequestPolicy(skip_methods=("GET",), include_paths=[r"^/toppings/\d+/publish/$"],
+                               exclude_paths=[r"^/health/", r"^/metrics/"])
+
+        self.assertFalse(policy.should_track(self.request("POST", "/health/")))
+        self.assertFalse(policy.should_track(self.request("POST", "/metrics/push/")))
+        self.assertTrue(policy.should_track(self.request("GET", "/toppings/1/publish/")))
+        self.assertFalse(policy.should_track(self.request("GET", "/toppings/1/")))
+
+    def test_sampling(self):
+        policy = RequestPolicy(sampling=[(r"^/telemetry/", 0), (r"^/", 1)])
+
+        self.assertFalse(policy.should_track(self.request("POST", "/telemetry/")))
+        self.assertTrue(policy.should_track(self.request("POST", "/toppings/")))
+
+    def test_untracked_request_has_no_audit_request(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS = [r"^/health/"]
+        seen = []
+
+        def view(request):
+            seen.append(AuditRequest.current_request())
+            return HttpResponse()
+
+        try:
+            middleware = TrackingRequestOnThreadLocalMiddleware(view)
+        finally:
+            audit_settings.DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS = ()
+        middleware(self.request("POST", "/health/"))
+        middleware(self.request("POST", "/toppings/"))
+
+        self.assertIsNone(seen[0])
+        self.assertEqual(seen[1].path, "/toppings/")
+
+    def test_untracked_request_clears_the_context(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS = [r"^/health/"]
+        seen = []
+
+        def view(request):
+            seen.append((AuditRequest.current_request(), writer.REQUEST_ENTRIES.get()))
+            return HttpResponse()
+
+        try:
+            middleware = TrackingRequestOnThreadLocalMiddleware(view)
+        finally:
+            audit_settings.DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS = ()
+        # left behind by a request that was not cleaned up
+        AuditRequest.new_request("/stale/", None, "127.0.0.1")
+        writer.start_request_buffer()
+        middleware(self.request("POST", "/health/"))
+
+        self.assertEqual(seen, [(None, None)])
+        self.assertIsNone(AuditRequest.current_request())
+
+
+class AsyncMiddlewareTest(TestCase):
+
+    async def test_concurrent_requests_do_not_share_the_audit_request(self):
+        seen = {}
+
+        async def view(request):
+            audit_request = AuditRequest.current_request()
+            # let the other request run before this one reads its context again
+            await asyncio.sleep(0.01)
+            seen[request.path] = (audit_request, AuditRequest.current_request())
+            return HttpResponse()
+
+        middleware = TrackingRequestOnThreadLocalMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        requests = []
+        for path in ("/first/", "/second/"):
+            request = AsyncRequestFactory().post(path)
+            request.user = AnonymousUser()
+            requests.append(request)
+        await asyncio.gather(*[middleware(request) for request in requests])
+
+        for path in ("/first/", "/second/"):
+            before, after = seen[path]
+            self.assertIs(before, after)
+            self.assertEqual(after.path, path)
+        self.assertIsNone(AuditRequest.current_request())
+
+    async def test_untracked_request_clears_the_context(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS = [r"^/health/"]
+        seen = []
+
+        async def view(request):
+            seen.append(AuditRequest.current_request())
+            return HttpResponse()
+
+        try:
+            middleware = TrackingRequestOnThreadLocalMiddleware(view)
+        finally:
+            audit_settings.DJANGO_SIMPLE_AUDIT_EXCLUDE_PATHS = ()
+        AuditRequest.new_request("/stale/", None, "127.0.0.1")
+        request = AsyncRequestFactory().post("/health/")
+        request.user = AnonymousUser()
+        await middleware(request)
+
+        self.assertEqual(seen, [None])
+
+
+class AsyncAuditTest(TransactionTestCase):
+
+    async def test_asave_audit_records_the_change(self):
+        topping = await Topping.objects.acreate(name="leek")
+        topping.description = "mild"
+
+        await asave_audit(topping, Audit.CHANGE)
+
+        audit = await Audit.objects.filter(object_id=topping.pk, operation=Audit.CHANGE).aget()
+        change = await audit.field_changes.aget()
+        self.assertEqual((change.field, change.old_value, change.new_value), ("description", None, "mild"))
+
+    async def test_audits_are_written_when_the_buffered_block_ends(self):
+        async with writer.abuffered():
+            first = await Topping.objects.acreate(name="mint")
+            second = Topping(name="dill")
+            await second.asave()
+            await asave_audit(second, Audit.CHANGE)
+            self.assertFalse(await Audit.objects.aexists())
+
+        self.assertEqual(await Audit.objects.filter(object_id__in=[first.pk, second.pk]).acount(), 2)
+
+    async def test_deleted_objects_are_audited_when_the_buffered_block_ends(self):
+        topping = await Topping.objects.acreate(name="okra")
+        pk = topping.pk
+        async with writer.abuffered():
+            other = await Topping.objects.acreate(name="kale")
+            await topping.adelete()
+
+        self.assertTrue(await Audit.objects.filter(object_id=pk, operation=Audit.DELETE).aexists())
+        self.assertTrue(await Audit.objects.filter(object_id=other.pk).aexists())
+
+    async def test_audits_of_failed_buffered_block_are_discarded(self):
+        with self.assertRaises(ValueError):
+            async with writer.abuffered():
+                await Topping.objects.acreate(name="cumin")
+                raise ValueError
+
+        self.assertFalse(await Audit.objects.aexists())
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS = True
+        register(Topping, Owner, VirtualMachine)
+        self.content_type_virtual_machine = ContentType.objects.get_for_model(VirtualMachine)
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_SNAPSHOTS = False
+
+    def test_change_does_not_select_old_state(self):
+        topping = Topping.objects.create(name="garlic")
+        topping = Topping.objects.get(pk=topping.pk)
+        topping.description = "white"
+
+        # update, audit and one audit change
+        with self.assertNumQueries(3):
+            topping.save()
+
+        field_change = Audit.objects.filter(object_id=topping.pk, operation=Audit.CHANGE).get().field_changes.get()
+        self.assertEqual(field_change.field, "description")
+        self.assertIsNone(field_change.old_value)
+        self.assertEqual(field_change.new_value, "white")
+
+    def test_snapshot_is_refreshed_after_save(self):
+        topping = Topping.objects.create(name="pepper")
+        topping.description = "hot"
+        topping.save()
+        topping.description = "very hot"
+        topping.save()
+
+        field_change = Audit.objects.filter(object_id=topping.pk, operation=Audit.CHANGE) \
+            .order_by('-id').first().field_changes.get()
+        self.assertEqual(field_change.old_value, "hot")
+        self.assertEqual(field_change.new_value, "very hot")
+
+    def test_foreign_key_change_from_snapshot(self):
+        owner = Owner.objects.create(name='Ionel')
+        other_owner = Owner.objects.create(name='Maria')
+        vm = VirtualMachine.objects.create(name='VM1', cpus=4, owner=owner, started=True)
+        vm = VirtualMachine.objects.get(pk=vm.pk)
+        vm.owner = other_owner
+        vm.started = False
+        vm.save()
+
+        audit = Audit.objects.get(content_type=self.content_type_virtual_machine, object_id=vm.pk,
+                                  operation=Audit.CHANGE)
+        field_change = audit.field_changes.get()
+        self.assertEqual(field_change.field, "owner")
+        self.assertEqual(field_change.old_value, str(owner.pk))
+        self.assertEqual(field_change.new_value, str(other_owner.pk))
+
+    def test_deferred_instance_falls_back_to_database(self):
+        topping = Topping.objects.create(name="ham", description="smoked")
+        topping = Topping.objects.only("name").get(pk=topping.pk)
+        topping.name = "bacon"
+        topping.save()
+
+        field_change = Audit.objects.get(object_id=topping.pk, operation=Audit.CHANGE).field_changes.get()
+        self.assertEqual(field_change.old_value, "ham")
+        self.assertEqual(field_change.new_value, "bacon")
+
+
+class WriterThreadTest(TransactionTestCase):
+
+    def setUp(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_WRITER_THREAD = True
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_WRITER_THREAD = False
+        worker.shutdown()
+
+    def test_audits_are_written_by_writer_thread(self):
+        ContentType.objects.get_for_model(Topping)
+        # only the topping insert runs in this thread
+        with self.assertNumQueries(1):
+            topping = Topping.objects.create(name="rucola")
+        worker.shutdown()
+
+        audit = Audit.objects.get(object_id=topping.pk)
+        self.assertEqual(audit.operation, Audit.ADD)
+        self.assertEqual(audit.field_changes.get(field="name").new_value, "rucola")
+
+    def test_deleted_objects_are_audited(self):
+        topping = Topping.objects.create(name="cardoon")
+        pk = topping.pk
+        other = Topping.objects.create(name="celeriac")
+        topping.delete()
+        worker.shutdown()
+
+        self.assertTrue(Audit.objects.filter(object_id=pk, operation=Audit.DELETE).exists())
+        self.assertTrue(Audit.objects.filter(object_id=other.pk, operation=Audit.ADD).exists())
+
+    def test_audits_of_rolled_back_transaction_are_not_written(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Topping.objects.create(name="borage")
+                raise ValueError
+        with transaction.atomic():
+            topping = Topping.objects.create(name="chervil")
+        worker.shutdown()
+
+        self.assertEqual(list(Audit.objects.values_list("object_id", flat=True)), [topping.pk])
+
+    def test_full_queue_drops_audits_when_not_blocking(self):
+        writer = worker.AuditWriterThread(batch_size=10, flush_interval=0.01, queue_size=1, block=False)
+        topping = Topping(name="mint")
+        audit = Audit.register(topping, "Added mint", Audit.ADD, commit=False)
+        writer.submit([(audit, []), (audit, [])])
+
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(writer.queue.qsize(), 1)
+
+
+class JournalTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        audit_settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR = self.directory
+
+    def tearDown(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_JOURNAL_DIR = None
+        journal.close()
+        AuditRequest.cleanup_request()
+        shutil.rmtree(self.directory)
+
+    def test_journaled_audits_are_ingested(self):
+        AuditRequest.new_request("/toppings/", None, "127.0.0.1")
+        with self.captureOnCommitCallbacks(execute=True):
+            topping = Topping.objects.create(name="anchovy")
+            topping.description = "salty"
+            topping.save()
+        journal.close()
+
+        self.assertFalse(Audit.objects.filter(object_id=topping.pk).exists())
+        self.assertFalse(AuditRequest.objects.exists())
+
+        call_command("ingest_audit_journal", stdout=open(os.devnull, "w"))
+
+        audits = Audit.objects.filter(object_id=topping.pk)
+        self.assertEqual(sorted(audits.values_list("operation", flat=True)), [Audit.ADD, Audit.CHANGE])
+        self.assertEqual(audits.get(operation=Audit.CHANGE).field_changes.get().new_value, "salty")
+        self.assertEqual(AuditRequest.objects.get().path, "/toppings/")
+        self.assertEqual(set(audits.values_list("audit_request__path", flat=True)), {"/toppings/"})
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertFalse(AuditJournalSegment.objects.exists())
+
+    def test_audits_of_rolled_back_transaction_are_not_journaled(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    Topping.objects.create(name="borage")
+                    raise ValueError
+        journal.close()
+
+        self.assertEqual(journal.list_segments(self.directory, include_open=True), [])
+
+    def test_idle_segment_is_closed_when_too_old(self):
+        idle = journal.Journal(self.directory, segment_size=1024 * 1024, segment_age=60, fsync=journal.FSYNC_NEVER)
+        audit = Audit.register(Topping(name="lemon balm"), "Added lemon balm", Audit.ADD, commit=False)
+        idle.append([(audit, [])])
+        self.assertEqual(idle.timer.interval, 60)
+        # what the timer calls once the segment is segment_age seconds old
+        idle._expire(idle.path)
+
+        self.assertIsNone(idle.timer)
+        self.assertEqual(len(journal.list_segments(self.directory)), 1)
+        self.assertEqual(journal.list_segments(self.directory, include_open=True),
+                         journal.list_segments(self.directory))
+
+    def test_ingest_resumes_from_checkpoint(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = Topping.objects.create(name="caper")
+            second = Topping.objects.create(name="endive")
+        journal.close()
+
+        segment, = journal.list_segments(self.directory)
+        with open(segment, "rb") as segment_file:
+            journal.write_checkpoint(segment, len(segment_file.readline()))
+
+        self.assertEqual(journal.ingest_segment(segment), 1)
+        self.assertFalse(Audit.objects.filter(object_id=first.pk).exists())
+        self.assertTrue(Audit.objects.filter(object_id=second.pk).exists())
+
+    def test_checkpoints_are_written_when_ingested(self):
+        audit_settings.DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL = 2
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                topping = Topping.objects.create(name="caper", description="0")
+                for index in range(1, 6):
+                    topping.description = str(index)
+                    topping.save()
+            journal.close()
+            call_command("ingest_audit_journal", stdout=open(os.devnull, "w"))
+        finally:
+            audit_settings.DJANGO_SIMPLE_AUDIT_CHECKPOINT_INTERVAL = 0
+
+        checkpoints = AuditCheckpoint.objects.filter(object_id=topping.pk).order_by("date", "audit_id")
+        self.assertEqual([json.loads(checkpoint.state)["description"] for checkpoint in checkpoints], ["1", "3", "5"])
+
+    def test_checkpoint_is_written_with_the_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            topping = Topping.objects.create(name="caper")
+        journal.close()
+        segment, = journal.list_segments(self.directory)
+
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                journal.ingest_segment(segment)
+                raise ValueError
+        self.assertEqual(journal.read_checkpoint(segment), 0)
+
+        self.assertEqual(journal.ingest_segment(segment), 1)
+        self.assertEqual(journal.read_checkpoint(segment), os.path.getsize(segment))
+        self.assertEqual(journal.ingest_segment(segment), 0)
+        self.assertEqual(Audit.objects.filter(object_id=topping.pk).count(), 1)
+
+
+class AuditedQuerySetTest(TestCase):
+
+    def setUp(self):
+        self.toppings = Topping.objects.bulk_create([Topping(name=name) for name in ("kale", "leek", "okra")])
+
+    def audits_for(self, topping, operation):
+        return Audit.objects.filter(object_id=topping.pk, operation=operation)
+
+    def test_bulk_create_is_audited(self):
+        for topping in self.toppings:
+            audit = self.audits_for(topping, Audit.ADD).get()
+            self.assertEqual(audit.description, "Added %s" % topping.name)
+            self.assertEqual(audit.field_changes.get(field="name").new_value, topping.name)
+
+    def test_bulk_create_ignoring_conflicts(self):
+        Topping.objects.bulk_create([Topping(name="kale", description="curly"), Topping(name="sorrel")],
+                                    ignore_conflicts=True)
+
+        self.assertEqual(Audit.objects.filter(content_type__model="topping", operation=Audit.ADD).count(), 4)
+        self.assertFalse(Audit.objects.filter(operation=Audit.CHANGE).exists())
+        self.assertTrue(self.audits_for(Topping.objects.get(name="sorrel"), Audit.ADD).exists())
+
+    def test_bulk_create_updating_conflicts(self):
+        Topping.objects.bulk_create([Topping(name="kale", description="curly"), Topping(name="sorrel")],
+                                    update_conflicts=True, unique_fields=["name"], update_fields=["description"])
+
+        change = self.audits_for(self.toppings[0], Audit.CHANGE).get().field_changes.get()
+        self.assertEqual((change.field, change.old_value, change.new_value), ("description", None, "curly"))
+        self.assertEqual(Audit.objects.filter(content_type__model="topping", operation=Audit.ADD).count(), 4)
+        self.assertTrue(self.audits_for(Topping.objects.get(name="sorrel"), Audit.ADD).exists())
+
+    def test_update_is_audited_in_bulk(self):
+        # old states, update, new states, and audits with their changes in a savepoint
+        with self.assertNumQueries(7):
+            rows = Topping.objects.filter(name__in=["kale", "leek"]).update(description="green")
+        self.assertEqual(rows, 2)
+
+        for topping in self.toppings[:2]:
+            change = self.audits_for(topping, Audit.CHANGE).get().field_changes.get()
+            self.assertEqual((change.field, change.old_value, change.new_value), ("description", None, "green"))
+        self.assertFalse(self.audits_for(self.toppings[2], Audit.CHANGE).exists())
+
+    def test_bulk_update_is_audited(self):
+        for topping in self.toppings:
+            topping.description = topping.name.upper()
+        Topping.objects.bulk_update(self.toppings, ["description"])
+
+        for topping in self.toppings:
+            change = self.audits_for(topping, Audit.CHANGE).get().field_changes.get()
+            self.assertEqual(change.new_value, topping.name.upper())
+
+    def test_unchanged_rows_are_not_audited(self):
+        Topping.objects.update(description=None)
+        self.assertFalse(Audit.objects.filter(operation=Audit.CHANGE).exists())
+
+    def test_delete_is_audited_once(self):
+        Topping.objects.filter(name="okra").delete()
+
+        audit = self.audits_for(self.toppings[2], Audit.DELETE).get()
+        self.assertEqual(audit.description, "Deleted okra")
+        self.assertEqual(audit.field_changes.get(field="name").new_value, "okra")